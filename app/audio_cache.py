@@ -0,0 +1,153 @@
+from app.config import *
+from app.database import get_db
+from app.metrics import stage_timer, record_error
+from collections import Counter
+import time
+
+#############################################
+# Audio Cache
+#############################################
+# Downloaded songs in `audio_cache_directory` are kept as a cache with a disk budget of
+# `audio_cache_max_bytes`, instead of wiping the whole folder every 90 minutes.
+#
+# - The `audio_cache` table indexes the files by YouTube video id, so a repeat request is
+#   played straight from disk.
+# - When the cache is over budget, the least recently played songs are deleted first.
+# - Songs that are playing or queued are pinned and never evicted.
+# - A song is only downloaded once it has been requested `audio_cache_min_plays` times, so
+#   one-off requests are streamed without also being written to disk.
+
+async def create_audio_cache_table():
+    db = await get_db()
+    await db.execute('''CREATE TABLE IF NOT EXISTS audio_cache
+                  (video_id TEXT PRIMARY KEY,
+                  path TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  last_played REAL NOT NULL)''')
+
+class AudioCache:
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or audio_cache_directory
+        self.max_bytes = max_bytes if max_bytes is not None else audio_cache_max_bytes
+        # video_id -> {'path', 'size', 'last_played'}
+        self.entries = {}
+        self.pins = Counter()
+        self.requests = Counter()
+        self.downloading = set()
+        self.tasks = set()
+
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    # Read the index at startup, forgetting files that have gone missing.
+    async def load(self):
+        db = await get_db()
+        rows = await db.fetchall('SELECT video_id, path, size, last_played FROM audio_cache')
+        missing = []
+        self.entries = {}
+        for row in rows:
+            if os.path.isfile(row['path']):
+                self.entries[row['video_id']] = {'path': row['path'], 'size': row['size'], 'last_played': row['last_played']}
+            else:
+                missing.append((row['video_id'],))
+        if missing:
+            await db.executemany('DELETE FROM audio_cache WHERE video_id = ?', missing)
+
+    # Returns the local file for the video, or None. Counts as a play for eviction order.
+    async def lookup(self, video_id):
+        self.requests[video_id] += 1
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return None
+        if not os.path.isfile(entry['path']):
+            await self._forget(video_id)
+            return None
+        entry['last_played'] = time.time()
+        db = await get_db()
+        await db.execute('UPDATE audio_cache SET last_played = ? WHERE video_id = ?', (entry['last_played'], video_id))
+        return entry['path']
+
+    def pin(self, video_id):
+        self.pins[video_id] += 1
+
+    def unpin(self, video_id):
+        self.pins[video_id] -= 1
+        if self.pins[video_id] <= 0:
+            del self.pins[video_id]
+
+    def should_cache(self, video_id):
+        return (self.max_bytes > 0
+                and video_id not in self.entries
+                and video_id not in self.downloading
+                and self.requests[video_id] >= audio_cache_min_plays)
+
+    # Download a video into the cache in the background. `download` is a blocking function
+    # that downloads the video and returns the path of the file.
+    async def fetch(self, video_id, download):
+        self.downloading.add(video_id)
+        try:
+            loop = asyncio.get_running_loop()
+            with stage_timer('ytdl_download'):
+                path = await loop.run_in_executor(None, download)
+            await self.add(video_id, path)
+        except Exception as e:
+            record_error('ytdl_download', e)
+        finally:
+            self.downloading.discard(video_id)
+
+    def fetch_in_background(self, video_id, download):
+        task = asyncio.create_task(self.fetch(video_id, download))
+        # Keep a reference so the task isn't garbage collected before it finishes.
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def add(self, video_id, path):
+        if not os.path.isfile(path):
+            return
+        entry = {'path': path, 'size': os.path.getsize(path), 'last_played': time.time()}
+        self.entries[video_id] = entry
+        db = await get_db()
+        await db.execute('INSERT OR REPLACE INTO audio_cache (video_id, path, size, last_played) VALUES (?, ?, ?, ?)',
+                         (video_id, entry['path'], entry['size'], entry['last_played']))
+        await self.enforce_budget()
+
+    # Evict the least recently played unpinned songs until the cache fits the budget.
+    async def enforce_budget(self):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        for video_id, entry in sorted(self.entries.items(), key=lambda item: item[1]['last_played']):
+            if total <= self.max_bytes:
+                break
+            if video_id in self.pins:
+                continue
+            total -= entry['size']
+            await self._forget(video_id)
+
+    async def _forget(self, video_id):
+        entry = self.entries.pop(video_id, None)
+        if entry is not None:
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                pass
+        db = await get_db()
+        await db.execute('DELETE FROM audio_cache WHERE video_id = ?', (video_id,))
+
+    # Routine maintenance: enforce the budget and delete stray files that aren't in the index,
+    # like partial downloads. Recently modified files are left alone in case they are still being written.
+    async def trim(self):
+        await self.enforce_budget()
+        if not os.path.isdir(self.directory):
+            return
+        known = set(os.path.abspath(entry['path']) for entry in self.entries.values())
+        cutoff = time.time() - 60 * 60
+        for file_name in os.listdir(self.directory):
+            file_path = os.path.join(self.directory, file_name)
+            if not os.path.isfile(file_path) or os.path.abspath(file_path) in known:
+                continue
+            if os.path.getmtime(file_path) < cutoff:
+                os.remove(file_path)
+
+# The process-wide audio cache.
+audio_cache = AudioCache()
@@ -1,16 +1,22 @@
 from app.config import *
+from app.database import get_db
+from app.reminder_scheduler import reminder_scheduler
+from app.prompt_history import prompt_history
+from app.send_scheduler import outbound
+from app.prompt_retention import prompt_retention
+from app.context_builder import count_tokens
+from app.conversation_summary import conversation_summaries
+from app.metrics import record_error
 
 #############################################
 # `prompts` Table
 #############################################
 # This function creates the prompts table. It is always run when the bot boots up.
 async def create_prompts_table():
-    # Connect to the SQLite3 database named 'data.db'
-    conn = await create_connection()
-    cursor = await conn.cursor()
+    db = await get_db()
 
     # Create the 'prompts' table if it doesn't already exist
-    await cursor.execute('''CREATE TABLE IF NOT EXISTS prompts
+    await db.execute('''CREATE TABLE IF NOT EXISTS prompts
                   (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   username TEXT NOT NULL,
                   prompt TEXT NOT NULL,
@@ -19,33 +25,74 @@ async def create_prompts_table():
                   channel_id TEXT,
                   channel_name TEXT,
                   keras_classified_as TEXT,
-                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  prompt_tokens INTEGER,
+                  response_tokens INTEGER)''')
+    # Token counts were added later. Add the columns to tables created before that.
+    columns = [row['name'] for row in await db.fetchall('PRAGMA table_info(prompts)')]
+    for column in ['prompt_tokens', 'response_tokens']:
+        if column not in columns:
+            await db.execute(f'ALTER TABLE prompts ADD COLUMN {column} INTEGER')
+    # Channel names are not unique across guilds, so history is looked up by channel id.
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_prompts_channel_id ON prompts (channel_id, id)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_prompts_channel_id_username ON prompts (channel_id, username, id)')
+
+# Older versions of the bot stored prompts by channel name only, and history is now looked up by
+# channel id. Run once the bot is connected: rows without a channel_id get the id of the text
+# channel with that name. Names shared by channels in several servers can't be told apart (the old
+# history was already mixed between them), so those rows are left alone and age out with retention.
+async def backfill_prompt_channel_ids(bot):
+    db = await get_db()
+    # Uses the (channel_id, id) index, so this is cheap once every row has a channel id.
+    if await db.fetchone('SELECT 1 FROM prompts WHERE channel_id IS NULL LIMIT 1') is None:
+        return
+    channel_ids = {}
+    for guild in bot.guilds:
+        for channel in guild.text_channels:
+            channel_ids.setdefault(channel.name, []).append(str(channel.id))
+    rows = await db.fetchall('SELECT DISTINCT channel_name FROM prompts WHERE channel_id IS NULL')
+    for row in rows:
+        ids = channel_ids.get(row['channel_name'], [])
+        if len(ids) != 1:
+            continue
+        await db.execute('UPDATE prompts SET channel_id = ? WHERE channel_id IS NULL AND channel_name = ?', (ids[0], row['channel_name']))
+        # Anything already read for this channel is missing the backfilled turns.
+        prompt_history.forget(ids[0])
+        conversation_summaries.channels.pop(ids[0], None)
+        print(f"Backfilled channel id {ids[0]} for past prompts in #{row['channel_name']}")
 
-    # Commit the changes and close the connection
-    await conn.commit()
-    await conn.close()
-    
 # This function is used to store a new conversation in the 'prompts' table.
-# It inserts a new row with the username, prompt, model, response, and channel_name into the table.
-async def store_prompt(db_conn, username, prompt, model, response, channel_name,keras_classified_as):
-    async with db_conn.cursor() as cursor:
-        await cursor.execute('INSERT INTO prompts (username, prompt, model, response, channel_name,keras_classified_as) VALUES (?, ?, ?, ?, ?, ?)', (username, prompt, model, response, channel_name,keras_classified_as))
-        await db_conn.commit()
-
-# This function is used to fetch past conversations from the 'prompts' table.
-async def fetch_prompts(db_conn, channel_name, limit):
-    async with db_conn.cursor() as cursor:
-        await cursor.execute('SELECT prompt, response FROM prompts WHERE channel_name = ? ORDER BY timestamp DESC LIMIT ?', (channel_name, limit,))
-        return await cursor.fetchall()
+# It inserts a new row with the username, prompt, model, response, channel_id and channel_name into the table,
+# and writes the turn through to the in-memory conversation history.
+# The prompt and response are tokenized here, once, so the context builder never has to (see `app/context_builder.py`).
+async def store_prompt(db_conn, username, prompt, model, response, channel_id, channel_name,keras_classified_as):
+    prompt_tokens = count_tokens(prompt)
+    response_tokens = count_tokens(response)
+    await db_conn.execute('INSERT INTO prompts (username, prompt, model, response, channel_id, channel_name,keras_classified_as, prompt_tokens, response_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (username, prompt, model, response, str(channel_id), channel_name,keras_classified_as, prompt_tokens, response_tokens))
+    prompt_history.append(channel_id, prompt, response, prompt_tokens, response_tokens)
+    prompt_retention.touch(channel_id)
+    if conversation_summaries_enabled:
+        await conversation_summaries.note_prompt(channel_id)
+
+# This function is used to fetch past conversations as (prompt, response, prompt_tokens, response_tokens), oldest first.
+# They are served from the in-memory history. The `prompts` table is only read the first time a channel is seen.
+async def fetch_prompts(db_conn, channel_id, limit):
+    if channel_id not in prompt_history:
+        rows = await db_conn.fetchall('SELECT prompt, response, prompt_tokens, response_tokens FROM prompts WHERE channel_id = ? ORDER BY id DESC LIMIT ?', (str(channel_id), prompt_history_cache_size,))
+        # Rows written before token counts were stored are counted once here.
+        prompt_history.load(channel_id, [(prompt, response,
+                                          prompt_tokens if prompt_tokens is not None else count_tokens(prompt),
+                                          response_tokens if response_tokens is not None else count_tokens(response))
+                                         for prompt, response, prompt_tokens, response_tokens in reversed(rows)])
+    return prompt_history.recent(channel_id, limit)
         
 #############################################
 # `labeled_prompts` Table
 #############################################
 
 async def create_labeled_prompts_table():
-    conn = await create_connection()
-    cursor = await conn.cursor()
-    await cursor.execute('''CREATE TABLE IF NOT EXISTS labeled_prompts
+    db = await get_db()
+    await db.execute('''CREATE TABLE IF NOT EXISTS labeled_prompts
                       (id INTEGER PRIMARY_KEY,
                       username TEXT NOT NULL,
                       prompt TEXT NOT NULL,
@@ -56,32 +103,25 @@ async def create_labeled_prompts_table():
                       keras_classified_as,
                       timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                       label TEXT)''')
-    await conn.commit()
-    await conn.close()
 
 
 # Used by users to label past prompts. 
 async def label_last_db(ctx,db_conn, label):
-    db_conn.row_factory = sqlite3.Row
-    async with db_conn.cursor() as cursor:
-        
-        await cursor.execute(f"""
-        SELECT * FROM prompts 
-        where channel_name = '{ctx.channel.name}' 
-            AND username = '{ctx.author.name}'
+    last_row = await db_conn.fetchone("""
+        SELECT id, username, prompt, model, response, channel_id, channel_name, keras_classified_as, timestamp FROM prompts 
+        where channel_id = ?
+            AND username = ?
         ORDER BY id DESC LIMIT 1
-        """)
-        last_row = await cursor.fetchone()
-       # If last_row is not None, insert its data into 'labeled_prompts'
-        if last_row is not None:
-            last_row = dict(last_row)
-            insert_query = '''INSERT INTO labeled_prompts (id, username, prompt, model, response, channel_id, channel_name,keras_classified_as,timestamp,label)
-                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
-            
-            await cursor.execute(insert_query,
-                                 tuple([last_row[key] for key in last_row.keys()] + [label]))
-            await db_conn.commit()
-            await ctx.send(f"Last prompt labeled as: {label} - {last_row['prompt']}")
+        """, (str(ctx.channel.id), ctx.author.name))
+    # If last_row is not None, insert its data into 'labeled_prompts'
+    if last_row is not None:
+        last_row = dict(last_row)
+        insert_query = '''INSERT INTO labeled_prompts (id, username, prompt, model, response, channel_id, channel_name,keras_classified_as,timestamp,label)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+        
+        await db_conn.execute(insert_query,
+                              tuple([last_row[key] for key in last_row.keys()] + [label]))
+        await ctx.send(f"Last prompt labeled as: {label} - {last_row['prompt']}")
 
 # '!label_last' command to correctly label the last prompt.
 async def label_last_prompt(ctx,label):
@@ -89,8 +129,7 @@ async def label_last_prompt(ctx,label):
     if label not in keras_labels:
         await ctx.send("Invalid label. Please use `!label_last reminder` if you meant to set a reminder, '!label_last youtube' for youtube, or `!label_last other` for the raw openAi model.")
         return
-    db_conn = await create_connection()
-    channel_name = ctx.channel.name
+    db_conn = await get_db()
     
     # label_last_prompt
     await label_last_db(ctx,db_conn,label)
@@ -100,10 +139,9 @@ async def label_last_prompt(ctx,label):
 #############################################
 
 async def create_reminder_table():
-    conn = await create_connection()
-    cursor = await conn.cursor()
+    db = await get_db()
 
-    await cursor.execute('''CREATE TABLE IF NOT EXISTS reminders
+    await db.execute('''CREATE TABLE IF NOT EXISTS reminders
                   (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   username TEXT NOT NULL,
                   reminder TEXT NOT NULL,
@@ -112,50 +150,35 @@ async def create_reminder_table():
                   reminder_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     # Delete reminders that build up each time the bot boots.
     # Clear out rows with null reminder_time
-    await cursor.execute("DELETE FROM reminders WHERE reminder_time IS NULL")
-    await conn.commit()
-    await conn.close()
-    
+    await db.execute("DELETE FROM reminders WHERE reminder_time IS NULL")
+
 # 'add_reminder' function is used to add a new reminder to the 'reminders' table.
+# The reminder is also handed to the scheduler so it fires on time.
 async def add_reminder(username, reminder, channel_id, channel_name, reminder_time):
-    conn = await aiosqlite.connect(db_name)
-    cursor = await conn.cursor()
-
-    await cursor.execute('INSERT INTO reminders (username, reminder, channel_id, channel_name, reminder_time) VALUES (?, ?, ?, ?, ?)',
-                         (username, reminder, channel_id, channel_name, reminder_time))
-    await conn.commit()
-    await conn.close()
+    db = await get_db()
+    cursor = await db.execute('INSERT INTO reminders (username, reminder, channel_id, channel_name, reminder_time) VALUES (?, ?, ?, ?, ?)',
+                              (username, reminder, channel_id, channel_name, reminder_time))
+    reminder_scheduler.add(cursor.lastrowid, username, reminder, channel_id, reminder_time)
+    return cursor.lastrowid
 
 # 'delete_reminder' function deletes a reminder from the 'reminders' table using the reminder_id.
 async def delete_reminder(reminder_id):
-    conn = await aiosqlite.connect(db_name)
-    cursor = await conn.cursor()
-
-    await cursor.execute('DELETE FROM reminders WHERE id = ?', (reminder_id,))
-    await conn.commit()
-    await conn.close()
+    db = await get_db()
+    await db.execute('DELETE FROM reminders WHERE id = ?', (reminder_id,))
+    reminder_scheduler.remove(reminder_id)
     
 # 'fetch_due_reminders' function fetches all reminders that are due to be sent.
 # It selects all reminders from the 'reminders' table where the reminder_time is less than or equal to the current timestamp.
 async def fetch_due_reminders():
-    conn = await aiosqlite.connect(db_name)
-    cursor = await conn.cursor()
-
-    await cursor.execute('SELECT id, username, reminder, channel_id, channel_name FROM reminders WHERE reminder_time <= CURRENT_TIMESTAMP')
-    reminders = await cursor.fetchall()
-
-    await conn.close()
-
-    return reminders
+    db = await get_db()
+    return await db.fetchall('SELECT id, username, reminder, channel_id, channel_name FROM reminders WHERE reminder_time <= CURRENT_TIMESTAMP')
 
 async def clear_user_reminders(ctx):
     """Clears all reminders of the invoking user"""
-    conn = await aiosqlite.connect(db_name)
-    cursor = await conn.cursor()
+    db = await get_db()
     # Delete records from the reminders table where username is ctx.author.name
-    await cursor.execute("DELETE FROM reminders WHERE username=?", (str(ctx.author.name),))
-    await conn.commit()
-    await conn.close()
+    await db.execute("DELETE FROM reminders WHERE username=?", (str(ctx.author.name),))
+    reminder_scheduler.remove_user(str(ctx.author.name))
 
     await ctx.send('All your reminders have been cleared.')
 
@@ -174,77 +197,28 @@ async def list_channels(bot):
             channel_names.append(channel.name)
     return channel_names
 
-# This function ensures the bot's memory usage remains low by maintaining a maximum of prompt_table_cache_size responses in the database.
-# It deletes the oldest entries if the count exceeds prompt_table_cache_size.
-# This function is also called upon bot startup.
-# You can customize the maximum number of entries by changing the 'max_rows' variable.
-async def delete_music_downloads(bot):
-    # Delete music downloads.
-    directory = 'app/downloads'
-    if os.path.exists(directory) and os.path.isdir(directory):
-        for file_name in os.listdir(directory):
-            file_path = os.path.join(directory, file_name)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-            elif os.path.isdir(file_path):
-                empty_directory(file_path)
-                os.rmdir(file_path)
-
-async def update_reminders_table(bot):
-    # Connect to the SQLite3 database named 'data.db'
-    conn = await create_connection()
-    cursor = await conn.cursor()
-    # Delete reminders with null value:
-    await cursor.execute("DELETE FROM reminders WHERE reminder_time IS NULL")
-    await conn.commit()
-    # Remove stale data. Currently, the last 200 record are kept.
-    # To change this, edit `prompt_table_cache_size` in `app/config.py`
-    await cursor.execute('SELECT COUNT(*) FROM prompts')
-    count = (await cursor.fetchall())[0][0]
-    max_rows = prompt_table_cache_size 
-    if count >= max_rows:
-        delete_count = count - max_rows - 1  # Calculate how many entries to delete
-        await cursor.execute(f'DELETE FROM prompts WHERE id IN (SELECT id FROM prompts ORDER BY timestamp ASC LIMIT {delete_count})')
-        await conn.commit()  # Commit the changes
-    # Close the database connection
-    await conn.close()
-
-    current_channels = await list_channels(bot)
-    async with aiosqlite.connect(db_name) as conn:
-            cursor = await conn.cursor()
-    
-    # Delete reminders from channels that no longer exist
-    current_channels = await list_channels(bot)
-
-async def send_reminders(bot):
-    conn = await create_connection()
-    cursor = await conn.cursor()
-    # Send out the reminders
-    await cursor.execute('''
-    SELECT 
-        username, 
-        reminder, 
-        channel_id, 
-        channel_name, 
-        reminder_time 
-    FROM reminders 
-    WHERE reminder_time is not null''')
-    
-    reminders = await cursor.fetchall()
-    
-    for reminder in reminders: 
-        username, reminder_text, channel_id, channel_name, reminder_time = reminder
-        reminder_time = datetime.strptime(reminder_time,"%Y-%m-%d %H:%M:%S")
-        
-        if datetime.now() >= reminder_time:
-            channel = bot.get_channel(int(channel_id))
-            if channel is not None:
-                await channel.send(f"@{username}, you set a reminder: {reminder_text}")
-            else:
-                print(f"Channel with ID {channel_id} not found.")
-
-            await cursor.execute('DELETE FROM reminders WHERE username = ? AND reminder_time = ?',
-                                 (username, reminder_time.strftime("%Y-%m-%d %H:%M:%S"),))
-
-    # Commit the changes here
-    await conn.commit()
\ No newline at end of file
+# Load every pending reminder into the scheduler. Run once when the bot connects.
+async def load_reminders():
+    db = await get_db()
+    rows = await db.fetchall('SELECT id, username, reminder, channel_id, reminder_time FROM reminders WHERE reminder_time IS NOT NULL')
+    reminder_scheduler.load(rows)
+
+# Called by the reminder scheduler with the reminders that just came due.
+# Sends go through the outbound scheduler, so reminders for different channels go out concurrently
+# and reminders due together in the same channel are merged into one message.
+async def send_reminders(bot, due_reminders):
+    db = await get_db()
+    sends = []
+    for reminder_time, reminder_id, username, reminder_text, channel_id in due_reminders:
+        channel = bot.get_channel(int(channel_id))
+        if channel is not None:
+            sends.append(outbound.send(channel, f"@{username}, you set a reminder: {reminder_text}"))
+        else:
+            print(f"Channel with ID {channel_id} not found.")
+    for result in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(result, Exception):
+            record_error('send_reminders', result)
+
+    # Delete the fired reminders by id
+    await db.executemany('DELETE FROM reminders WHERE id = ?',
+                         [(reminder[1],) for reminder in due_reminders])
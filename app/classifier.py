@@ -0,0 +1,202 @@
+from app.config import *
+from app.retrain_worker import progress_prefix
+from app.metrics import metrics, record_error
+from collections import OrderedDict
+import sys
+import time
+
+#############################################
+# Task Assignment
+#############################################
+# Picks the classifier backend set by `classifier_backend` in `app/config.py`.
+# Both backends expose the same interface:
+#     await train_keras()             train (or load) the model (`train_numpy` for numpy)
+#     predict_labels(messages)        classify a list of messages in one call (blocking)
+#     install_retrained(result)       swap in a model trained by `retrain_classifier`
+if classifier_backend == 'numpy':
+    from app.numpy_layer import train_numpy as train_backend, predict_labels, install_retrained
+else:
+    from app.keras_layer import train_keras as train_backend, predict_labels, install_retrained
+
+#############################################
+# Classification Cache
+#############################################
+# Users repeat the same short commands ("play lofi", "stop", ...) all the time. Results are kept
+# in an LRU cache keyed on the normalized message and the model version, so repeats skip the model.
+# Normalizing is lowercasing and collapsing whitespace, which is exactly what both backends do
+# before tokenizing, so a cached label is always the label the model would have returned.
+# Every new model bumps the version and empties the cache.
+# Hits and misses are counted in `fefe_classification_cache_lookups_total`, next to the cache's
+# current and maximum size, so `classify_cache_size` can be tuned from `/metrics` or `!stats`.
+
+def normalize_prompt(message):
+    return ' '.join(message.lower().split())
+
+class ClassificationCache:
+    def __init__(self, size=None):
+        self.size = size if size is not None else classify_cache_size
+        self.entries = OrderedDict()
+        self.model_version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, message):
+        return (normalize_prompt(message), self.model_version)
+
+    def get(self, key):
+        label = self.entries.get(key)
+        if label is None:
+            self.misses += 1
+            metrics.inc('fefe_classification_cache_lookups_total', result='miss')
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        metrics.inc('fefe_classification_cache_lookups_total', result='hit')
+        return label
+
+    def put(self, key, label):
+        # Results that finish after a model swap carry the old version and are dropped.
+        if self.size <= 0 or key[1] != self.model_version:
+            return
+        self.entries[key] = label
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def new_model(self):
+        self.model_version += 1
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'model_version': self.model_version}
+
+classification_cache = ClassificationCache()
+metrics.register_gauge('fefe_classification_cache_hit_rate', lambda: classification_cache.stats()['hit_rate'], 'Share of classify_prompt calls answered from the cache')
+metrics.register_gauge('fefe_classification_cache_size', lambda: len(classification_cache.entries), 'Classifications currently cached')
+metrics.register_gauge('fefe_classification_cache_max_size', lambda: classification_cache.size, 'Most classifications the cache holds (classify_cache_size)')
+
+# Train (or load) the model, and start a fresh cache for it.
+async def train_keras():
+    await train_backend()
+    classification_cache.new_model()
+
+#############################################
+# Micro-batching
+#############################################
+# `classify_prompt` doesn't run the model itself. It queues the message and waits.
+# A single worker collects whatever arrives within `classify_batch_window` seconds (or until
+# `classify_max_batch` messages are waiting), runs one `predict_labels` call for all of them
+# in a worker thread, and hands each caller its label. While one batch is predicting the next
+# one is already filling up, so a burst of `!fefe` messages costs a few predict calls instead
+# of one each, and the event loop never waits on the model.
+
+class BatchClassifier:
+    def __init__(self, predict, window=None, max_batch=None):
+        self.predict = predict
+        self.window = window if window is not None else classify_batch_window
+        self.max_batch = max_batch or classify_max_batch
+        self.queue = None
+        self.task = None
+
+    async def classify(self, message):
+        if self.task is None or self.task.done():
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((message, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            messages = [message for message, _ in batch]
+            try:
+                labels = await loop.run_in_executor(None, self.predict, messages)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), label in zip(batch, labels):
+                if not future.done():
+                    future.set_result(label)
+
+batch_classifier = BatchClassifier(predict_labels)
+
+# Returns one of `keras_labels` for the message.
+async def classify_prompt(input_string):
+    key = classification_cache.key(input_string)
+    label = classification_cache.get(key)
+    if label is None:
+        label = await batch_classifier.classify(input_string)
+        classification_cache.put(key, label)
+    return label
+
+#############################################
+# Background Retraining
+#############################################
+# `!retrain_keras` must not train on the event loop, so training runs in a separate process.
+# `report` is awaited with each progress message (e.g. to edit a status message in the channel).
+# Classification keeps using the old model the whole time. When training finishes the new model
+# is loaded in a worker thread and swapped in with a single assignment.
+retrain_lock = asyncio.Lock()
+
+def classifier_retraining():
+    return retrain_lock.locked()
+
+async def retrain_classifier(report):
+    async with retrain_lock:
+        loop = asyncio.get_running_loop()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'app.retrain_worker', classifier_backend,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        result = None
+        error = None
+        last_report = 0
+        try:
+            async for line in process.stdout:
+                line = line.decode('utf-8', errors='replace').strip()
+                # Anything else on stdout is library chatter.
+                if not line.startswith(progress_prefix):
+                    continue
+                payload = json.loads(line[len(progress_prefix):])
+                if 'progress' in payload:
+                    # Throttle progress updates so they stay under Discord's rate limits.
+                    if time.monotonic() - last_report >= classifier_progress_interval:
+                        last_report = time.monotonic()
+                        # Progress updates are best effort. A failed edit mustn't stop the retrain.
+                        try:
+                            await report(payload['progress'])
+                        except Exception as e:
+                            record_error('retrain_report', e)
+                result = payload.get('result', result)
+                error = payload.get('error', error)
+            await process.wait()
+        finally:
+            # If we stopped early (an error or cancellation), don't leave the worker training and
+            # overwriting the saved model behind our back.
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        if process.returncode != 0 or result is None:
+            raise RuntimeError(error or f'retrain_worker exited with code {process.returncode}')
+        await loop.run_in_executor(None, install_retrained, result)
+        classification_cache.new_model()
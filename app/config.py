@@ -5,7 +5,18 @@ from discord.ext import commands,tasks
 # Set up Discord Bot token here:
 discord_bot_token = os.environ.get("DISCORD_BOT_TOKEN")
 
-import pandas as pd
+# Minimum number of seconds between edits when streaming a response into a Discord message.
+# Discord allows roughly 5 edits per 5 seconds per channel.
+discord_stream_edit_interval = 1.0
+# Responses that would take more than this many 2000 character messages are sent as a file attachment instead.
+discord_max_chunks = 5
+# Pacing for messages the bot sends on its own, like reminders (see app/send_scheduler.py).
+# Each channel may burst `discord_channel_burst` messages, refilled at `discord_channel_rate` per second,
+# and the whole bot stays under `discord_global_rate` messages per second.
+discord_channel_burst = 5
+discord_channel_rate = 1.0
+discord_global_rate = 50
+
 from datetime import datetime, timedelta
 import json
 ############################################
@@ -15,27 +26,79 @@ import openai
 # Set up the OpenAI API. The key is stored as an environment variable for security reasons.
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 
+# Maximum number of openAI completions in flight at once across the whole bot.
+openai_max_concurrency = 32
+# Seconds to wait on a single completion attempt before giving up on it.
+openai_request_timeout = 60
+# How many times a failed completion is retried. The wait doubles each time, starting at `openai_retry_backoff` seconds.
+openai_max_retries = 3
+openai_retry_backoff = 1
+# Stream responses into Discord as they are generated instead of waiting for the whole answer.
+openai_stream_responses = True
+# Identical openAI requests made at the same time share one upstream call. See `app/llm_client.py`.
+openai_singleflight = True
+
 ############################################
 # Youtube Data API config
 ############################################
-import yt_dlp
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 # Set up the Google Youtube Data API key. For youtube searching and playback.
 google_api_key = os.environ.get("google_api_key")
 
-# Set up the YouTube Data API client
-youtube = build("youtube", "v3", developerKey=google_api_key)
+# The YouTube Data API client is built the first time it is needed rather than at import,
+# since loading the discovery document adds noticeably to startup time.
+youtube_client = None
+
+def get_youtube():
+    global youtube_client
+    if youtube_client is None:
+        from googleapiclient.discovery import build
+        youtube_client = build("youtube", "v3", developerKey=google_api_key)
+    return youtube_client
+
+# How long music requests are cached (seconds). See `app/youtube_cache.py`.
+# Message text -> search query:
+youtube_query_cache_ttl = 7 * 24 * 60 * 60
+# Search query -> video:
+youtube_search_cache_ttl = 7 * 24 * 60 * 60
+# Number of cache entries also kept in memory.
+youtube_cache_memory_size = 512
+
+# Stream songs straight from YouTube instead of downloading the whole file before playback starts.
+youtube_stream_audio = True
+# Send Opus audio to Discord without decoding and re-encoding it. See `create_audio_source` in `app/music_player.py`.
+opus_passthrough = True
+
+# Songs are cached on disk in `audio_cache_directory`. See `app/audio_cache.py`.
+audio_cache_directory = 'app/downloads'
+# Disk budget for cached songs, in bytes. The least recently played songs are deleted first.
+audio_cache_max_bytes = 2 * 1024 ** 3
+# When streaming, a song is downloaded into the cache once it has been requested this many times.
+audio_cache_min_plays = 2
 
 #############################################
 # KERAS LAYER - Task Assignment
 #############################################
 import numpy as np
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Embedding, GlobalMaxPooling1D
-from tensorflow.keras.optimizers import Adam
 # Number of training epochs for the keras layer.
 epochs = 25
+# Where trained classifier models are saved. The keras model is reloaded on startup when the training data hasn't changed.
+keras_model_dir = 'app/keras_model'
+
+# Which classifier routes messages between reminders, youtube and openAI. See `app/classifier.py`.
+# 'keras' is the original TensorFlow model. 'numpy' is a hashed n-gram linear model (`app/numpy_layer.py`)
+# that doesn't import TensorFlow and trains in well under a second.
+# `python benchmarks/compare_classifiers.py` compares their accuracy and latency on your data.
+classifier_backend = 'keras'
+
+# Messages that arrive within `classify_batch_window` seconds of each other are classified together
+# in one predict call, up to `classify_max_batch` at a time.
+classify_batch_window = 0.005
+classify_max_batch = 32
+# Number of recent classifications remembered, keyed on the normalized message. 0 turns the cache off.
+classify_cache_size = 1024
+# Seconds between progress updates posted to the channel while `!retrain_keras` runs.
+classifier_progress_interval = 5
 
 
 # Define the labels for task assignment in the Keras model
@@ -55,10 +118,50 @@ import asyncio
 # Where you wish to store the bot data.
 db_name = 'app/data.db'
 
-# Number of prompts stored in the local SQLite database. The table is truncated when the bot starts up.
+# Number of prompts stored in the local SQLite database. Older rows are trimmed every minute. See `app/prompt_retention.py`.
 prompt_table_cache_size = 200
+# Number of prompts kept per channel on top of the global limit. 0 keeps no per-channel limit.
+prompt_channel_cache_size = 0
+# Gzipped JSONL file that trimmed prompts are appended to, e.g. 'app/prompts_archive.jsonl.gz'. None deletes them.
+prompt_archive_file = None
+
+# Number of recent turns per channel kept in memory for conversation history. See `app/prompt_history.py`.
+prompt_history_cache_size = 50
+# Number of channels whose history is kept in memory at once.
+prompt_history_channels = 1000
+
+# Token budget for the conversation history sent with each openAI request. See `app/context_builder.py`.
+# As many recent turns as fit are sent, the oldest one that doesn't fit is truncated.
+openai_context_token_budget = 2000
+# An old turn is only truncated to fit if at least this many tokens are left for it, otherwise it is dropped.
+openai_context_min_turn_tokens = 64
+
+# Rolling per-channel conversation summaries. See `app/conversation_summary.py`.
+conversation_summaries_enabled = True
+# The summary is refreshed once this many new turns have come in after the raw turns below.
+conversation_summary_every = 10
+# Number of newest turns always sent verbatim instead of being folded into the summary.
+conversation_summary_raw_turns = 4
+# Model and length of the summaries.
+conversation_summary_model = 'gpt-3.5-turbo'
+conversation_summary_max_tokens = 300
+# Each prompt and response is cut to this many tokens before being summarized.
+conversation_summary_turn_tokens = 500
+# Most tokens of turns folded into the summary by one refresh. A longer backlog (e.g. history from
+# before summaries were enabled) is summarized a chunk per refresh.
+conversation_summary_input_tokens = 3000
+# After a failed refresh the channel waits this many seconds before trying again, doubling with
+# each further failure up to `conversation_summary_max_retry_backoff`.
+conversation_summary_retry_backoff = 60
+conversation_summary_max_retry_backoff = 3600
+
+# The bot shares one connection pool for the whole process. See `app/database.py`.
+# Number of read-only connections kept open for queries.
+db_reader_pool_size = 3
+# Maximum number of queued writes committed together in one transaction.
+db_write_batch_size = 64
 
-# This function establishes a global connection to the 'data.db' SQLite database.
-# It is used by some other functions whenever they need to interact with the database.
-async def create_connection():
-    return await aiosqlite.connect(db_name)
\ No newline at end of file
+# Metrics are served for Prometheus on http://metrics_host:metrics_port/metrics. See `app/metrics.py`.
+# Set `metrics_port` to None to turn the endpoint off. `!stats` works either way.
+metrics_host = '127.0.0.1'
+metrics_port = 9108
@@ -0,0 +1,81 @@
+from app.config import *
+
+# tiktoken is optional. Without it token counts are estimated from the text length.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+#############################################
+# Token-budgeted conversation context
+#############################################
+# `fefe_openai` used to send exactly 5 past turns, no matter how big they were. Instead,
+# `pack_turns` packs as many recent turns as fit in `openai_context_token_budget` tokens:
+#
+# - `store_prompt` counts the tokens of the prompt and response once, when the row is written,
+#   and the counts live alongside the turn in the `prompts` table and the history cache.
+#   Packing only adds up those stored numbers, history is never tokenized again.
+# - Turns are taken newest first. The first turn that doesn't fit is truncated to the space
+#   that's left (if at least `openai_context_min_turn_tokens`) and packing stops there.
+
+# Rough cost of the role and separators openAI adds around every chat message.
+tokens_per_message = 4
+# Used when tiktoken isn't installed. English text averages about 4 characters per token.
+chars_per_token = 4
+
+encoding = None
+
+def get_encoding():
+    global encoding
+    if encoding is None and tiktoken is not None:
+        encoding = tiktoken.get_encoding('cl100k_base')
+    return encoding
+
+def count_tokens(text):
+    if not text:
+        return 0
+    enc = get_encoding()
+    if enc is None:
+        return (len(text) + chars_per_token - 1) // chars_per_token
+    return len(enc.encode(text, disallowed_special=()))
+
+# Cut text down to at most `max_tokens` tokens, marking the cut with an ellipsis.
+def truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 0:
+        return ''
+    enc = get_encoding()
+    if enc is None:
+        max_chars = max_tokens * chars_per_token
+        return text if len(text) <= max_chars else text[:max_chars - 1] + '…'
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens - 1]) + '…'
+
+def turn_messages(prompt, response):
+    return [{'role': 'user', 'content': prompt}, {'role': 'assistant', 'content': response}]
+
+# `turns` are (prompt, response, prompt_tokens, response_tokens), oldest first.
+# Returns the chat messages for the turns that fit in `budget` tokens, oldest first.
+def pack_turns(turns, budget=None, min_turn_tokens=None):
+    budget = budget if budget is not None else openai_context_token_budget
+    min_turn_tokens = min_turn_tokens if min_turn_tokens is not None else openai_context_min_turn_tokens
+    packed = []
+    remaining = budget
+    for prompt, response, prompt_tokens, response_tokens in reversed(turns):
+        size = prompt_tokens + response_tokens + 2 * tokens_per_message
+        if size <= remaining:
+            packed.append(turn_messages(prompt, response))
+            remaining -= size
+            continue
+        # Truncate the turn to the space that's left, giving the prompt at most half of it.
+        space = remaining - 2 * tokens_per_message
+        if space >= min_turn_tokens:
+            prompt_space = min(prompt_tokens, space // 2)
+            packed.append(turn_messages(truncate_to_tokens(prompt, prompt_space),
+                                        truncate_to_tokens(response, space - prompt_space)))
+        break
+    messages = []
+    for turn in reversed(packed):
+        messages.extend(turn)
+    return messages
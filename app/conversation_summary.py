@@ -0,0 +1,169 @@
+from app.config import *
+from app.database import get_db
+from app.llm_client import chat_completion
+from app.context_builder import count_tokens, truncate_to_tokens
+from app.metrics import stage_timer, record_error
+from app.prompt_retention import prompt_retention
+from collections import OrderedDict
+import time
+
+#############################################
+# Rolling conversation summaries
+#############################################
+# Busy channels have more history than fits in a request. Each channel keeps a rolling summary
+# in the `channel_summaries` table covering every turn up to `last_prompt_id`, and `fefe_openai`
+# sends the summary followed by the turns that came after it.
+#
+# - `store_prompt` calls `note_prompt` for every new row. Once a channel has
+#   `conversation_summary_raw_turns + conversation_summary_every` turns after its summary, the
+#   summary is refreshed in a background task, off the request path.
+# - A refresh folds the oldest turns after the summary, up to `conversation_summary_input_tokens`
+#   and never the newest `conversation_summary_raw_turns`, into the summary with one openAI call.
+#   Only new turns are read, never the whole history, and a long backlog is worked through a chunk
+#   per refresh so no request outgrows the model's context window.
+# - A failed refresh is retried on a later prompt after `conversation_summary_retry_backoff`
+#   seconds, doubling with each failure, instead of on every prompt.
+# - Per channel we remember the summary and how many turns came after it (`unsummarized`).
+#   State for the `prompt_history_channels` most recently used channels is kept in memory.
+
+summary_instructions = """You maintain a running summary of a Discord channel's conversation with an assistant named fefe.
+Update the summary with the new messages. Keep names, facts, decisions, open questions and anything the users asked fefe to remember.
+Drop small talk. Reply with the updated summary only, in at most {max_tokens} tokens."""
+
+async def create_channel_summaries_table():
+    db = await get_db()
+    await db.execute('''CREATE TABLE IF NOT EXISTS channel_summaries
+                  (channel_id TEXT PRIMARY KEY,
+                  summary TEXT NOT NULL,
+                  summary_tokens INTEGER NOT NULL,
+                  last_prompt_id INTEGER NOT NULL,
+                  updated_at REAL NOT NULL)''')
+
+class ConversationSummaries:
+    def __init__(self, every=None, raw_turns=None, max_channels=None):
+        self.every = every or conversation_summary_every
+        self.raw_turns = raw_turns if raw_turns is not None else conversation_summary_raw_turns
+        self.max_channels = max_channels or prompt_history_channels
+        # channel id -> {'summary', 'summary_tokens', 'last_prompt_id', 'unsummarized', 'failures', 'retry_at'}
+        self.channels = OrderedDict()
+        self.refreshing = set()
+        self.tasks = set()
+
+    async def _state(self, channel_id):
+        channel_id = str(channel_id)
+        state = self.channels.get(channel_id)
+        if state is None:
+            db = await get_db()
+            row = await db.fetchone('SELECT summary, summary_tokens, last_prompt_id FROM channel_summaries WHERE channel_id = ?', (channel_id,))
+            if row is None:
+                state = {'summary': None, 'summary_tokens': 0, 'last_prompt_id': 0}
+            else:
+                state = {'summary': row['summary'], 'summary_tokens': row['summary_tokens'], 'last_prompt_id': row['last_prompt_id']}
+            state['failures'] = 0
+            state['retry_at'] = 0
+            # Uses the (channel_id, id) index, and only counts the turns after the summary.
+            count = await db.fetchone('SELECT COUNT(*) FROM prompts WHERE channel_id = ? AND id > ?', (channel_id, state['last_prompt_id']))
+            state['unsummarized'] = count[0]
+            self.channels[channel_id] = state
+        self.channels.move_to_end(channel_id)
+        while len(self.channels) > self.max_channels:
+            self.channels.popitem(last=False)
+        return state
+
+    # Returns (summary, summary_tokens, unsummarized turns). The summary is None until the channel has one.
+    async def get(self, channel_id):
+        state = await self._state(channel_id)
+        return state['summary'], state['summary_tokens'], state['unsummarized']
+
+    # Called by `store_prompt` after the row has been written.
+    async def note_prompt(self, channel_id):
+        channel_id = str(channel_id)
+        loaded = channel_id in self.channels
+        state = await self._state(channel_id)
+        if loaded:
+            state['unsummarized'] += 1
+        if (state['unsummarized'] >= self.raw_turns + self.every and channel_id not in self.refreshing
+                and time.monotonic() >= state['retry_at']):
+            self.refreshing.add(channel_id)
+            task = asyncio.create_task(self.refresh(channel_id))
+            # Keep a reference so the task isn't garbage collected before it finishes.
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def refresh(self, channel_id):
+        with stage_timer('summarize'):
+            try:
+                await self._refresh(channel_id)
+            except Exception as e:
+                record_error('summarize', e)
+                state = self.channels.get(channel_id)
+                if state is not None:
+                    state['failures'] += 1
+                    backoff = conversation_summary_retry_backoff * 2 ** (state['failures'] - 1)
+                    state['retry_at'] = time.monotonic() + min(backoff, conversation_summary_max_retry_backoff)
+            finally:
+                self.refreshing.discard(channel_id)
+
+    async def _refresh(self, channel_id):
+        state = await self._state(channel_id)
+        db = await get_db()
+        # The newest `raw_turns` turns are sent verbatim, so only rows up to the one before them are summarized.
+        newest = await db.fetchone('SELECT id FROM prompts WHERE channel_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?', (channel_id, self.raw_turns))
+        if newest is None:
+            return
+
+        # Take the oldest turns that fit in `conversation_summary_input_tokens`, reading a few rows at a time.
+        lines = []
+        used = 0
+        last_prompt_id = state['last_prompt_id']
+        turns = 0
+        full = False
+        while not full:
+            rows = await db.fetchall('SELECT id, username, prompt, response, prompt_tokens, response_tokens FROM prompts WHERE channel_id = ? AND id > ? AND id <= ? ORDER BY id LIMIT ?',
+                                     (channel_id, last_prompt_id, newest[0], self.every))
+            if not rows:
+                break
+            for row in rows:
+                prompt_tokens = row['prompt_tokens'] if row['prompt_tokens'] is not None else count_tokens(row['prompt'])
+                response_tokens = row['response_tokens'] if row['response_tokens'] is not None else count_tokens(row['response'] or '')
+                tokens = min(prompt_tokens, conversation_summary_turn_tokens) + min(response_tokens, conversation_summary_turn_tokens)
+                # Always take at least one turn so a refresh makes progress.
+                if turns and used + tokens > conversation_summary_input_tokens:
+                    full = True
+                    break
+                lines.append(f"{row['username']}: {truncate_to_tokens(row['prompt'], conversation_summary_turn_tokens)}")
+                if row['response']:
+                    lines.append(f"fefe: {truncate_to_tokens(row['response'], conversation_summary_turn_tokens)}")
+                used += tokens
+                last_prompt_id = row['id']
+                turns += 1
+        if not turns:
+            return
+
+        previous = state['summary'] or '(none yet)'
+        response = await chat_completion(
+            model=conversation_summary_model,
+            messages=[
+                {'role': 'system', 'content': summary_instructions.format(max_tokens=conversation_summary_max_tokens)},
+                {'role': 'user', 'content': f"Current summary:\n{previous}\n\nNew messages:\n" + '\n'.join(lines)},
+            ],
+            max_tokens=conversation_summary_max_tokens,
+            temperature=0,
+        )
+        summary = response['choices'][0]['message']['content'].strip()
+        summary_tokens = count_tokens(summary)
+
+        await db.execute('INSERT OR REPLACE INTO channel_summaries (channel_id, summary, summary_tokens, last_prompt_id, updated_at) VALUES (?, ?, ?, ?, ?)',
+                         (channel_id, summary, summary_tokens, last_prompt_id, time.time()))
+        # Turns stored while we were summarizing are still counted in `unsummarized`.
+        state['summary'] = summary
+        state['summary_tokens'] = summary_tokens
+        state['last_prompt_id'] = last_prompt_id
+        state['unsummarized'] = max(0, state['unsummarized'] - turns)
+        state['failures'] = 0
+        state['retry_at'] = 0
+        # Turns the summary now covers no longer need to be kept.
+        prompt_retention.touch(channel_id)
+
+# The process-wide summaries.
+conversation_summaries = ConversationSummaries()
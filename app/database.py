@@ -0,0 +1,157 @@
+from app.config import *
+from app.metrics import stage_timer
+
+#############################################
+# Shared SQLite access layer
+#############################################
+# One `Database` is shared by the whole process instead of opening a new aiosqlite
+# connection (and with it a new thread) for every query.
+#
+# - The database runs in WAL mode so readers never block the writer and vice versa.
+# - All writes go through a single writer connection fed by a queue. The writer drains
+#   whatever has queued up (up to `db_write_batch_size` statements) and commits them
+#   together, so a burst of inserts costs one commit instead of one per row.
+# - Reads are served from a small pool of `db_reader_pool_size` connections.
+#
+# Rows come back as `sqlite3.Row`, so they can be unpacked like tuples or read by column name.
+#
+# Usage:
+#     db = await get_db()
+#     cursor = await db.execute('INSERT INTO ...', (...))
+#     rows = await db.fetchall('SELECT ...', (...))
+
+class Database:
+    def __init__(self, path, readers=None, batch_size=None):
+        self.path = path
+        self.reader_count = readers or db_reader_pool_size
+        self.batch_size = batch_size or db_write_batch_size
+        self.writer = None
+        self.writer_task = None
+        self.write_queue = None
+        self.readers = None
+        self.reader_connections = []
+
+    async def start(self):
+        self.writer = await aiosqlite.connect(self.path)
+        await self.writer.execute('PRAGMA journal_mode=WAL')
+        await self.writer.execute('PRAGMA synchronous=NORMAL')
+        await self.writer.commit()
+
+        self.readers = asyncio.Queue()
+        for _ in range(self.reader_count):
+            conn = await aiosqlite.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            self.reader_connections.append(conn)
+            self.readers.put_nowait(conn)
+
+        self.write_queue = asyncio.Queue()
+        self.writer_task = asyncio.create_task(self._write_loop())
+
+    async def close(self):
+        if self.writer_task is not None:
+            # Let queued writes finish before shutting the writer down.
+            await self.write_queue.join()
+            self.writer_task.cancel()
+            try:
+                await self.writer_task
+            except asyncio.CancelledError:
+                pass
+        for conn in self.reader_connections:
+            await conn.close()
+        if self.writer is not None:
+            await self.writer.close()
+        self.writer = None
+        self.writer_task = None
+        self.reader_connections = []
+
+    #---------------------------------------------
+    # Writes
+    #---------------------------------------------
+    # Queue a statement for the writer and wait until it has been committed.
+    # Returns the cursor, so callers can read `lastrowid` and `rowcount`.
+    async def execute(self, sql, params=()):
+        future = asyncio.get_running_loop().create_future()
+        self.write_queue.put_nowait((sql, params, False, future))
+        with stage_timer('sqlite_write'):
+            return await future
+
+    async def executemany(self, sql, seq_of_params):
+        future = asyncio.get_running_loop().create_future()
+        self.write_queue.put_nowait((sql, list(seq_of_params), True, future))
+        with stage_timer('sqlite_write'):
+            return await future
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self.write_queue.get()]
+            while len(batch) < self.batch_size and not self.write_queue.empty():
+                batch.append(self.write_queue.get_nowait())
+
+            results = []
+            for sql, params, many, future in batch:
+                try:
+                    if many:
+                        cursor = await self.writer.executemany(sql, params)
+                    else:
+                        cursor = await self.writer.execute(sql, params)
+                    results.append((future, cursor, None))
+                except Exception as e:
+                    results.append((future, None, e))
+            try:
+                await self.writer.commit()
+            except Exception as e:
+                results = [(future, None, e) for future, _, _ in results]
+
+            for future, cursor, error in results:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(cursor)
+            for _ in batch:
+                self.write_queue.task_done()
+
+    #---------------------------------------------
+    # Reads
+    #---------------------------------------------
+    # Timings include waiting for a free reader connection.
+    async def fetchall(self, sql, params=()):
+        with stage_timer('sqlite_read'):
+            conn = await self.readers.get()
+            try:
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchall()
+            finally:
+                self.readers.put_nowait(conn)
+
+    async def fetchone(self, sql, params=()):
+        with stage_timer('sqlite_read'):
+            conn = await self.readers.get()
+            try:
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchone()
+            finally:
+                self.readers.put_nowait(conn)
+
+# The process-wide database. Opened on first use.
+db = None
+db_lock = asyncio.Lock()
+
+async def get_db():
+    global db
+    if db is None:
+        async with db_lock:
+            if db is None:
+                database = Database(db_name)
+                await database.start()
+                db = database
+    return db
+
+# Close the shared database. The next `get_db()` call opens it again, which is how the
+# boot sequence hands over from its own event loop to the one `bot.run` starts.
+async def close_db():
+    global db
+    if db is not None:
+        database, db = db, None
+        await database.close()
@@ -1,6 +1,8 @@
 from app.config import *
 from app.bot_functions import *
-from app.keras_layer import classify_prompt
+from app.database import get_db
+from app.classifier import classify_prompt
+from app.metrics import metrics, stage_timer, record_error
 
 # For creating reminders
 from app.fefe_create_reminder import *
@@ -13,32 +15,35 @@ async def talk_to_fefe(ctx, message,bot):
 
     model = "gpt-3.5-turbo"
     
-    db_conn = await create_connection()
+    db_conn = await get_db()
     username = ctx.author.name
     
     channel_name = ctx.channel.name
     try:
-        message_category = await classify_prompt(message)
+        with stage_timer('classify'):
+            message_category = await classify_prompt(message)
         message_classified =True
     except Exception as e:
         # Capture the error message
         error_message = str(e)
-        print(type(message))
-        print(message)
+        record_error('classify', e)
         await ctx.send(f"""
         I'll need a bit more training to answer your question.
         Run `!label_last <label>` by replacing '<label>' with one of the following request types: {str(keras_labels)}. Then run `!retrain_keras`.
         """)
-        await store_prompt(db_conn, ctx.author.name, message, model,'', channel_name,keras_classified_as = 'ERROR')
+        await store_prompt(db_conn, ctx.author.name, message, model,'', ctx.channel.id, channel_name,keras_classified_as = 'ERROR')
         return
 
-    # bot's Reminder Capabilities
-    if message_category == 'reminder':
-        await set_reminder(ctx,message,model,db_conn)
-    # Bot's openAi capabilities
-    elif message_category == 'other':
-        await fefe_openai(ctx,message,model,db_conn)
-    
-    # Bot's youtube capabilities
-    elif message_category == 'youtube':
-        await fefe_youtube(bot,ctx,message,model,db_conn)
\ No newline at end of file
+    metrics.inc('fefe_requests_total', route=message_category)
+    # Each route is timed as a whole, on top of the stages inside it.
+    with stage_timer(f'route_{message_category}'):
+        # bot's Reminder Capabilities
+        if message_category == 'reminder':
+            await set_reminder(ctx,message,model,db_conn)
+        # Bot's openAi capabilities
+        elif message_category == 'other':
+            await fefe_openai(ctx,message,model,db_conn)
+        
+        # Bot's youtube capabilities
+        elif message_category == 'youtube':
+            await fefe_youtube(bot,ctx,message,model,db_conn)
\ No newline at end of file
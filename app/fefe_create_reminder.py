@@ -1,44 +1,69 @@
 from app.config import * 
 from app.bot_functions import *
+from app.llm_client import chat_completion
+from app.message_sender import send_chunks
+from app.reminder_parser import parse_reminder, count_parse
+from app.reminder_scheduler import reminder_time_format
 
-async def set_reminder(ctx,message,model,db_conn):
-    messages = []
-    messages.extend([{'role':'user','content':'remind me to turn in my homework next week in the morning.'},
-                    {'role':'assistant','content':"""{"message":"Turn in homework","reminder_time":"(datetime.now() + timedelta(weeks=1)).strftime('%Y-%m-%d 09:00:00')"} """}])
-    messages.extend([{'role': 'user', 'content': "Remind me in three hours to pick up the kids."},
-                  {'role': 'assistant', 'content': """{"message":"Pick up the kids","reminder_time":"(datetime.now() + timedelta(hours=3)).strftime('%Y-%m-%d %H:%M:00')"} """}])
-    messages.extend([{'role': 'user', 'content': 'Remind me to buy groceries tomorrow.'},
-                    {'role': 'assistant', 'content': """{"message":"Buy groceries","reminder_time":"(datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:00')"} """}])
-    messages.extend([{'role': 'user', 'content': 'Remind me in 30 minutes to call my mom.'},
-                     {'role': 'assistant', 'content': """{"message":"Call mom","reminder_time":"(datetime.now() + timedelta(minutes=30)).strftime('%Y-%m-%d %H:%M:00')"} """}])
-    messages.append({'role':'user','content':f'Put this in the same format as before: {message}'})
-    response = openai.ChatCompletion.create(
+# Used when the local parser can't read the reminder. The model has to answer by calling this
+# function, so we get validated JSON arguments back instead of text to eval.
+reminder_function = {
+    'name': 'set_reminder',
+    'description': 'Set a reminder for the user.',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'message': {'type': 'string', 'description': 'What to remind the user about, as a short phrase, e.g. "Call mom".'},
+            'reminder_time': {'type': 'string', 'description': 'When to send the reminder, as YYYY-MM-DD HH:MM:SS in the same time zone as the current time.'},
+        },
+        'required': ['message', 'reminder_time'],
+    },
+}
+
+# Ask openAI for the reminder. Returns (reminder text, due datetime) or None if the answer isn't usable.
+async def parse_reminder_with_llm(message, model):
+    now = datetime.now().replace(microsecond=0)
+    response = await chat_completion(
         model=model,
-        messages=messages,        
-        max_tokens=1024,
-        n=1,
-        temperature=0.5,
-        top_p=1,
-        frequency_penalty=0.0,
-        presence_penalty=0.6,
+        messages=[
+            {'role': 'system', 'content': f"The current time is {now.strftime('%A ' + reminder_time_format)}. "
+                                          "Read the user's reminder request and call set_reminder."},
+            {'role': 'user', 'content': message},
+        ],
+        functions=[reminder_function],
+        function_call={'name': 'set_reminder'},
+        max_tokens=100,
+        temperature=0,
     )
-    
-    # Extract the response text and send it back to the user
-    response_text = response['choices'][0]['message']['content']
+    function_call = response['choices'][0]['message'].get('function_call')
     try:
-        response_text = eval(response_text)
-    
-        reminder_time = eval(response_text['reminder_time'])
-    except Exception as e:
-        await ctx.send(response_text)
-    
-    dictionary = {
-        'message': response_text['message'],
-        'response_time': reminder_time
-    }
-    
-    await store_prompt(db_conn, ctx.author.name, message, model, f"Reminder set for {reminder_time}.", ctx.channel.name,keras_classified_as='reminder')
+        arguments = json.loads(function_call['arguments'])
+        reminder_text = str(arguments['message']).strip()
+        due = datetime.strptime(arguments['reminder_time'].strip(), reminder_time_format)
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return None
+    if not reminder_text or due <= now:
+        return None
+    return reminder_text, due
+
+async def set_reminder(ctx,message,model,db_conn):
+    # Try the local parser first. Only unusual phrasings cost an openAI round trip.
+    parsed = parse_reminder(message)
+    if parsed is None:
+        count_parse('llm')
+        parsed = await parse_reminder_with_llm(message, model)
+    if parsed is None:
+        count_parse('failed')
+        response_text = "Sorry, I couldn't work out when to remind you. Try something like `remind me in 30 minutes to call mom`."
+        await send_chunks(ctx, response_text)
+        await store_prompt(db_conn, ctx.author.name, message, model, response_text, ctx.channel.id, ctx.channel.name,keras_classified_as='reminder')
+        return
+
+    reminder_text, due = parsed
+    reminder_time = due.strftime(reminder_time_format)
+
+    await store_prompt(db_conn, ctx.author.name, message, model, f"Reminder set for {reminder_time}.", ctx.channel.id, ctx.channel.name,keras_classified_as='reminder')
     
     # Add the new reminder to the database
-    await add_reminder(ctx.author.name, response_text['message'], ctx.channel.id, ctx.channel.name, reminder_time)
+    await add_reminder(ctx.author.name, reminder_text, ctx.channel.id, ctx.channel.name, reminder_time)
     await ctx.send(f"Reminder set for {reminder_time}.")
@@ -1,16 +1,27 @@
 from app.config import *
 from app.bot_functions import *
+from app.llm_client import shared_chat_completion, shared_stream_chat_completion
+from app.message_sender import StreamingMessage, send_chunks
+from app.context_builder import pack_turns
+from app.conversation_summary import conversation_summaries
 
 async def fefe_openai(ctx,message,model,db_conn):
-    past_prompts = await fetch_prompts(db_conn, ctx.channel.name, 5)  # Fetch the last 5 prompts and responses
     messages = []
-    # Construct the messages parameter with the past prompts and responses and the current message
-    for prompt, response in past_prompts:
-        messages.extend([{'role': 'user', 'content': prompt}, {'role': 'assistant', 'content': response}])
+    history_limit = prompt_history_cache_size
+    budget = openai_context_token_budget
+    # Busy channels have a rolling summary of the older turns. Send it, followed by the turns that came after it.
+    if conversation_summaries_enabled:
+        summary, summary_tokens, unsummarized = await conversation_summaries.get(ctx.channel.id)
+        if summary is not None:
+            messages.append({'role': 'system', 'content': f"Summary of the earlier conversation in this channel:\n{summary}"})
+            history_limit = unsummarized
+            budget -= summary_tokens
+    past_prompts = await fetch_prompts(db_conn, ctx.channel.id, history_limit)  # Fetch the prompts and responses, oldest first
+    # Construct the messages parameter with as many past prompts and responses as fit in the token budget, and the current message
+    messages.extend(pack_turns(past_prompts, budget))
     messages.append({'role': 'user', 'content': message})
 
-    # Generate a response using the 'gpt-3.5-turbo' model
-    response = openai.ChatCompletion.create(
+    completion_args = dict(
         model=model,
         messages=messages,
         max_tokens=1024,
@@ -21,13 +32,24 @@ async def fefe_openai(ctx,message,model,db_conn):
         presence_penalty=0.6,
     )
 
-    # Extract the response text and send it back to the user
-    response_text = response['choices'][0]['message']['content']
-    if len(response_text) > 2000:
-        await send_chunks(ctx, response_text)
+    if openai_stream_responses:
+        # Post a placeholder right away and edit it as the tokens come in
+        streamer = StreamingMessage(ctx)
+        await streamer.start()
+        failed = True
+        try:
+            async for token in shared_stream_chat_completion(**completion_args):
+                streamer.append(token)
+            failed = False
+        finally:
+            response_text = await streamer.finish(failed=failed)
     else:
-        await ctx.send(response_text)
+        # Generate a response using the 'gpt-3.5-turbo' model
+        response = await shared_chat_completion(**completion_args)
+
+        # Extract the response text and send it back to the user
+        response_text = response['choices'][0]['message']['content']
+        await send_chunks(ctx, response_text)
 
     # Store the new prompt and response in the 'prompts' table
-    await store_prompt(db_conn, ctx.author.name, message, model, response_text, ctx.channel.name,keras_classified_as='other')
-    await db_conn.close()
\ No newline at end of file
+    await store_prompt(db_conn, ctx.author.name, message, model, response_text, ctx.channel.id, ctx.channel.name,keras_classified_as='other')
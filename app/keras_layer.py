@@ -1,132 +1,115 @@
 from app.config import *
+from app.training_data import load_training_data
+import hashlib
+import uuid
 
-max_sequence_length = None
-word_to_index = None
-model = None
-label_to_index = None 
+from tensorflow.keras.models import Sequential
+from tensorflow.keras.layers import Dense, Embedding, GlobalMaxPooling1D
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.callbacks import Callback
+
+############################################
+#  Model Bundle
+############################################
+# Everything classification needs is kept together in one `KerasModel`. The live model is the
+# single global `current_model`, so swapping in a retrained model is one assignment and
+# `predict_labels` can never see the new lookup tables with the old weights.
+class KerasModel:
+    def __init__(self, model, word_to_index, label_to_index, max_sequence_length):
+        self.model = model
+        self.word_to_index = word_to_index
+        self.label_to_index = label_to_index
+        self.index_to_label = {v: k for k, v in label_to_index.items()}
+        self.max_sequence_length = max_sequence_length
+
+current_model = None
+
+############################################
+#  Saved Model
+############################################
+# Training runs 25 epochs over every labeled prompt, so we don't want to pay for it on every boot.
+# After training, the weights and the lookup tables are saved to `keras_model_dir` together with
+# a hash of the training data. On the next start, if the hash still matches, they are loaded instead.
+# Each save writes its weights to a new file, named in the metadata, so `model.json` is the only
+# file that is ever replaced and the weights it names always belong to its lookup tables.
+keras_meta_file = os.path.join(keras_model_dir, 'model.json')
+
+def hash_training_data(messages, labels):
+    payload = json.dumps({'messages': messages,
+                          'labels': labels,
+                          'keras_labels': keras_labels,
+                          'epochs': epochs})
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def build_model(vocab_size, max_sequence_length):
+    model = Sequential()
+    model.add(Embedding(input_dim=vocab_size, output_dim=50, input_length=max_sequence_length))
+    model.add(GlobalMaxPooling1D())
+    model.add(Dense(16, activation='relu'))
+    model.add(Dense(len(keras_labels), activation='softmax'))  # assuming you have 3 classes
+    return model
+
+def save_keras_model(bundle, training_hash):
+    os.makedirs(keras_model_dir, exist_ok=True)
+    # The weights go to a file no earlier save used. Then the metadata, which names that file and
+    # holds the hash, is renamed into place. A crash or kill at any point leaves either the old
+    # model or the new one, never new weights with an old vocabulary (`word_to_index` comes from
+    # set order, which differs between processes).
+    weights_name = f'model-{uuid.uuid4().hex}.weights.h5'
+    bundle.model.save_weights(os.path.join(keras_model_dir, weights_name))
+    with open(keras_meta_file + '.tmp', 'w') as f:
+        json.dump({'training_hash': training_hash,
+                   'weights_file': weights_name,
+                   'vocab_size': len(bundle.word_to_index),
+                   'max_sequence_length': bundle.max_sequence_length,
+                   'word_to_index': bundle.word_to_index,
+                   'label_to_index': bundle.label_to_index}, f)
+    os.replace(keras_meta_file + '.tmp', keras_meta_file)
+    # Remove weights from earlier saves (and from saves that never got their metadata written).
+    for name in os.listdir(keras_model_dir):
+        if name.endswith('.weights.h5') and name != weights_name:
+            try:
+                os.remove(os.path.join(keras_model_dir, name))
+            except OSError:
+                pass
+
+# Returns the saved model if it matches `training_hash`, otherwise None.
+def load_keras_model(training_hash):
+    try:
+        with open(keras_meta_file) as f:
+            meta = json.load(f)
+        # Models saved before the weights file was named in the metadata are retrained once.
+        if meta['training_hash'] != training_hash or 'weights_file' not in meta:
+            return None
+        saved_model = build_model(meta['vocab_size'], meta['max_sequence_length'])
+        saved_model.build((None, meta['max_sequence_length']))
+        saved_model.load_weights(os.path.join(keras_model_dir, meta['weights_file']))
+    except Exception as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"Could not load the saved keras model, retraining: {e}")
+        return None
+    return KerasModel(saved_model, meta['word_to_index'], meta['label_to_index'], meta['max_sequence_length'])
 
 async def train_keras():
-    global max_sequence_length
-    global word_to_index
-    global label_to_index
-    global model
-    ############################################
-    # Training Data
-    ############################################
-    
-    # When adding new features that require task assignment in the Keras model,
-    # make sure to update the list of labels accordingly in conjunction with the changes made in app/keras_layer.py.
-    
-    sample_data = {
-        """
-        organize this code for me with comments.
-        
-        **`config.py`**
-        ```
-        import openai
-        db_name = 'app/data.db' # Where you wish to store the bot data. 
-        
-        
-        openai.api_key = os.environ.get("OPENAI_API_KEY") # Set up the OpenAI API. The key is stored as an environment variable for security reasons. 
-        
-        google_api_key = os.environ.get("google_api_key") # Set up the Google Youtube Data API key. For youtube searching and playback.
-        
-        epochs = 25 # Number of training epochs for the keras layer.
-        
-        prompt_table_cache_size = 200 # Number of prompts stored in the local SQLite database. The table is truncated when the bot starts up.
-        
-        #############################################
-        # KERAS LAYER - Task Assignment
-        #############################################
-        
-        # Define the labels for task assignment in the Keras model
-        keras_labels = ['other', 'reminder', 'youtube']
-        
-        # Note for developers:
-        # When adding new features that require task assignment in the Keras model,
-        # make sure to update this list of labels accordingly in conjunction with the changes made in app/keras_layer.py.
-        ```
-        """: 'other',
-        'Remind me to pick up the kids in 45 minutes': 'reminder',
-        'Remind me to turn in my homework at midnight': 'reminder',
-        "What's your favorite color?": 'other',
-        'Remind me to call mom at 3pm.': 'reminder',
-        'Can you send me the report?': 'other',
-        'Buy tickets for the concert': 'other',
-        'Remind me to pick up some milk later.': 'reminder',
-        'Remind us to study for the final exam next week.': 'reminder',
-        'remind me to fix my essay in an hour.': 'reminder',
-        'remind me to throw my shoes away in three days.': 'reminder',
-        'About how many atoms are there in the universe?': 'other',
-        'Remind me to feed the dog at 6pm.': 'reminder',
-        "Let's play a game.": 'other',
-        'Can you turn on the TV?': 'other',
-        'Remind me to check my email after dinner.': 'reminder',
-        "What's the weather like today?": 'other',
-        'Remind me to take my medicine at 8am.': 'reminder',
-        "Let's order pizza for dinner.": 'other',
-        'Remind me to water the plants tomorrow morning.': 'reminder',
-        'How many planets are there in our solar system?': 'other',
-        "Remind me to book a doctor's appointment next Monday.": 'reminder',
-        'Can you find a good recipe for spaghetti bolognese?': 'other',
-        'Remind me to charge my phone.': 'reminder',
-        'Who won the basketball game last night?': 'other',
-        'Remind me to finish my online course this weekend.': 'reminder',
-        'Can you tell me a joke?': 'other',
-        'Remind me to call the plumber tomorrow.': 'reminder',
-        "What's the capital of Australia?": 'other',
-        "Remind me to renew my driver's license next month.": 'reminder',
-        'Remind me to buy groceries on the way home.': 'reminder',
-        'What time is it?': 'other',
-        'Remind me to pick up my dry cleaning this afternoon.': 'reminder',
-        'Who won the Oscar for Best Picture last year?': 'other',
-        'Remind me to check the oven in 30 minutes.': 'reminder',
-        'Can you recommend a good book?': 'other',
-        'Remind me to schedule a team meeting for next Tuesday.': 'reminder',
-        "What's the score of the baseball game?": 'other',
-        'Remind me to fill up the car with gas tomorrow.': 'reminder',
-        'Can you find the fastest route to the airport?': 'other',
-        'Remind me to pay the electric bill by the end of the week.': 'reminder',
-        'Who is the president of the United States?': 'other',
-        'Remind me to update my resume this weekend.': 'reminder',
-        'Can you play my favorite song?': 'other',
-        'Remind me to check in for my flight 24 hours before departure.': 'reminder',
-        'What are the ingredients in a Caesar salad?': 'other',
-        "Remind me to bring my umbrella if it's going to rain tomorrow.": 'reminder',
-        'How do you make a margarita?': 'other',
-        'In a short answer, tell me how to write pi/2 as an infinite sum.': 'other',
-        'Play Spirit in the Sky.': 'youtube',
-        'I want to listen to Jay-Z': 'youtube',
-        'Can you find a video explaining how quantum computers work?': 'youtube',
-        'Play the phantom of the opera.': 'youtube',
-        'play a song from the guardians of the galaxy soundtrack.': 'youtube',
-        'can you find a video about the mathematics of neural networks?': 'youtube'}
-
-    messages = list(sample_data.keys())
-    labels = list(sample_data.values())
-    
-    ############################################
-    # Import labeled prompts
-    ############################################
-    #---------------------------------------------
-    # Check if `data.db` has labeled_prompts table
-    conn = sqlite3.connect(db_name)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    # Execute the query to retrieve the table names
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    tables = cursor.fetchall()
-    tables = [table[0] for table in tables]
-    if 'labeled_prompts' in tables:
-        cursor.execute("select prompt,label from labeled_prompts")
-        rows = cursor.fetchall()
-        if rows is not None:
-            dict_rows = [dict(row) for row in rows]
-            messages += [row['prompt'] for row in dict_rows]
-            labels += [row['label'] for row in dict_rows]
-        
-    conn.close()
-    
+    global current_model
+    messages, labels = load_training_data()
+
+    # Skip training if nothing has changed since the model was last saved.
+    training_hash = hash_training_data(messages, labels)
+    bundle = load_keras_model(training_hash)
+    if bundle is not None:
+        print('Loaded saved keras model.')
+        current_model = bundle
+        return
+
+    bundle = fit_keras(messages, labels)
+
+    # Save the model so the next boot can skip training
+    save_keras_model(bundle, training_hash)
+    current_model = bundle
+
+# Train a fresh model on the given messages and labels. Returns a `KerasModel`.
+def fit_keras(messages, labels, verbose=1, callbacks=None):
     ############################################
     #  Preprocessing
     ############################################
@@ -147,39 +130,65 @@ async def train_keras():
     y = np.array([label_to_index[label] for label in labels])
 
     # Define the model
-    model = Sequential()
-    model.add(Embedding(input_dim=vocab_size, output_dim=50, input_length=max_sequence_length))
-    model.add(GlobalMaxPooling1D())
-    model.add(Dense(16, activation='relu'))
-    model.add(Dense(len(keras_labels), activation='softmax'))  # assuming you have 3 classes
+    model = build_model(vocab_size, max_sequence_length)
 
     # Compile the model
-    model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy']) 
+    model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
 
 
     # Train the model
-    model.fit(X, y, epochs=epochs, batch_size=1, verbose=1)
+    model.fit(X, y, epochs=epochs, batch_size=1, verbose=verbose, callbacks=callbacks)
+
+    return KerasModel(model, word_to_index, label_to_index, max_sequence_length)
 
 ############################################
-#  Classification Function
+#  Background Retraining
 ############################################
-async def classify_prompt(input_string):
-    global max_sequence_length
-    global word_to_index
-    global model
+# `!retrain_keras` trains in a separate process (see `app/classifier.py`). `retrain` runs in that
+# process and saves the model to disk; `install_retrained` runs in the bot and swaps it in.
+class ProgressCallback(Callback):
+    def __init__(self, report):
+        super().__init__()
+        self.report = report
 
-    # Preprocess the input string
-    new_sequence = np.zeros((1, max_sequence_length))
-    words = input_string.lower().split()
-    for j, word in enumerate(words):
-        if word in word_to_index:
-            new_sequence[0, j] = word_to_index[word]
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        self.report(f"Epoch {epoch + 1}/{epochs} - loss: {logs.get('loss', 0):.4f} - accuracy: {logs.get('accuracy', 0):.2%}")
 
-    # Make prediction
-    prediction = model.predict(new_sequence)
-    predicted_index = np.argmax(prediction)  # Change here, get the index of max value
-    index_to_label = {v: k for k, v in label_to_index.items()}
-    predicted_label = index_to_label[predicted_index]
+def retrain(report):
+    messages, labels = load_training_data()
+    report(f"Training on {len(messages)} examples.")
+    bundle = fit_keras(messages, labels, verbose=0, callbacks=[ProgressCallback(report)])
+    training_hash = hash_training_data(messages, labels)
+    save_keras_model(bundle, training_hash)
+    return training_hash
+
+def install_retrained(training_hash):
+    global current_model
+    bundle = load_keras_model(training_hash)
+    if bundle is None:
+        raise RuntimeError('The retrained keras model could not be loaded.')
+    current_model = bundle
+
+############################################
+#  Classification Function
+############################################
+# Classify a batch of messages with a single predict call. Runs synchronously, so call it
+# off the event loop (see `app/classifier.py`). Words past `max_sequence_length` are ignored.
+def predict_labels(messages):
+    # Read the global once so a swap halfway through can't mix two models.
+    bundle = current_model
+    sequences = np.zeros((len(messages), bundle.max_sequence_length))
+    for i, message in enumerate(messages):
+        words = message.lower().split()[:bundle.max_sequence_length]
+        for j, word in enumerate(words):
+            if word in bundle.word_to_index:
+                sequences[i, j] = bundle.word_to_index[word]
 
-    return predicted_label
+    # Make prediction
+    predictions = bundle.model.predict_on_batch(sequences)
+    predicted_indices = np.argmax(predictions, axis=1)  # get the index of max value for each row
+    return [bundle.index_to_label[int(index)] for index in predicted_indices]
 
+async def classify_prompt(input_string):
+    return predict_labels([input_string])[0]
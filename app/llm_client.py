@@ -0,0 +1,195 @@
+from app.config import *
+from app.metrics import metrics, stage_timer
+import aiohttp
+
+#############################################
+# Async LLM client
+#############################################
+# Every handler that talks to openAI goes through `chat_completion` instead of calling
+# `openai.ChatCompletion.create` directly. The synchronous client blocks the discord.py
+# event loop for the whole completion, which stalls heartbeats, other commands and the
+# task loops. Here we use the async client, cap the number of completions in flight with
+# a semaphore, and retry transient failures with exponential backoff.
+#
+# Tune `openai_max_concurrency`, `openai_request_timeout`, `openai_max_retries` and
+# `openai_retry_backoff` in `app/config.py`. Retries are counted in `fefe_openai_retries_total`.
+#
+# openai 0.28 opens a new aiohttp session, and so a new TCP and TLS connection, for every request
+# unless `openai.aiosession` is set. All completions share one session per event loop instead,
+# so connections to openAI are reused. `close_http_session` closes it on shutdown.
+
+# Errors worth retrying. Anything else (bad request, auth, etc.) is raised immediately.
+retryable_errors = (
+    asyncio.TimeoutError,
+    openai.error.Timeout,
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+llm_semaphore = asyncio.Semaphore(openai_max_concurrency)
+
+http_session = None
+http_session_loop = None
+
+# Point openai at the shared session. `openai.aiosession` is a context variable, so it is set
+# in the calling task right before each request.
+def use_http_session():
+    global http_session, http_session_loop
+    loop = asyncio.get_running_loop()
+    # The boot sequence and `bot.run` use different event loops, and a session only works on its own.
+    if http_session is None or http_session.closed or http_session_loop is not loop:
+        http_session = aiohttp.ClientSession()
+        http_session_loop = loop
+    openai.aiosession.set(http_session)
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+async def chat_completion(**kwargs):
+    attempt = 0
+    while True:
+        try:
+            async with llm_semaphore:
+                with stage_timer('openai'):
+                    use_http_session()
+                    return await asyncio.wait_for(
+                        openai.ChatCompletion.acreate(request_timeout=openai_request_timeout, **kwargs),
+                        timeout=openai_request_timeout,
+                    )
+        except retryable_errors as e:
+            if attempt >= openai_max_retries:
+                raise
+            delay = openai_retry_backoff * (2 ** attempt)
+            metrics.inc('fefe_openai_retries_total', error=type(e).__name__)
+            attempt += 1
+            # Sleep outside of the semaphore so waiting retries don't hold a slot.
+            await asyncio.sleep(delay)
+
+# Streaming variant of `chat_completion`. Yields the text of each delta as it arrives.
+# Failures are only retried before the first token is yielded; once the user has seen
+# part of an answer we can't transparently restart it.
+async def stream_chat_completion(**kwargs):
+    attempt = 0
+    while True:
+        started = False
+        try:
+            async with llm_semaphore:
+                # 'openai_first_token' is the wait for the response to start, the rest is streaming.
+                with stage_timer('openai_first_token'):
+                    use_http_session()
+                    response = await asyncio.wait_for(
+                        openai.ChatCompletion.acreate(request_timeout=openai_request_timeout, stream=True, **kwargs),
+                        timeout=openai_request_timeout,
+                    )
+                chunks = response.__aiter__()
+                while True:
+                    try:
+                        # The timeout applies to the gap between chunks, not the whole answer.
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=openai_request_timeout)
+                    except StopAsyncIteration:
+                        return
+                    content = chunk['choices'][0].get('delta', {}).get('content')
+                    if content:
+                        started = True
+                        yield content
+        except retryable_errors as e:
+            if started or attempt >= openai_max_retries:
+                raise
+            delay = openai_retry_backoff * (2 ** attempt)
+            metrics.inc('fefe_openai_retries_total', error=type(e).__name__)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+#############################################
+# Single-flight requests
+#############################################
+# When an announcement goes out, several people often ask fefe the same thing within seconds,
+# which means identical completion requests (same history, same prompt). With `openai_singleflight`
+# on, `shared_chat_completion` and `shared_stream_chat_completion` send only the first of those
+# upstream. Everyone who asks while it is in flight shares its result; a shared stream replays
+# the tokens so far and then follows along. Calls saved are counted in `fefe_llm_calls_saved_total`.
+#
+# Requests match when their arguments are equal after collapsing whitespace in the message contents.
+# The upstream call runs in its own task, so one caller giving up doesn't cancel it for the others.
+
+inflight_requests = {}
+
+def request_key(kind, kwargs):
+    normalized = dict(kwargs)
+    normalized['messages'] = [dict(message, content=' '.join(message['content'].split()))
+                              if isinstance(message.get('content'), str) else message
+                              for message in kwargs.get('messages', [])]
+    return kind, json.dumps(normalized, sort_keys=True, default=str)
+
+def finish_request(key, task):
+    inflight_requests.pop(key, None)
+    # Mark the error as retrieved in case every caller gave up waiting.
+    if not task.cancelled():
+        task.exception()
+
+async def shared_chat_completion(**kwargs):
+    if not openai_singleflight:
+        return await chat_completion(**kwargs)
+    key = request_key('completion', kwargs)
+    task = inflight_requests.get(key)
+    if task is None:
+        task = asyncio.create_task(chat_completion(**kwargs))
+        inflight_requests[key] = task
+        task.add_done_callback(lambda done: finish_request(key, done))
+    else:
+        metrics.inc('fefe_llm_calls_saved_total', kind='completion')
+    return await asyncio.shield(task)
+
+class SharedStream:
+    def __init__(self, kwargs):
+        self.tokens = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self._pump(kwargs))
+
+    async def _pump(self, kwargs):
+        try:
+            async for token in stream_chat_completion(**kwargs):
+                self.tokens.append(token)
+                self.changed.set()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.changed.set()
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            while index < len(self.tokens):
+                yield self.tokens[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            self.changed.clear()
+            await self.changed.wait()
+
+async def shared_stream_chat_completion(**kwargs):
+    if not openai_singleflight:
+        async for token in stream_chat_completion(**kwargs):
+            yield token
+        return
+    key = request_key('stream', kwargs)
+    stream = inflight_requests.get(key)
+    if stream is None:
+        stream = SharedStream(kwargs)
+        inflight_requests[key] = stream
+        stream.task.add_done_callback(lambda done: inflight_requests.pop(key, None))
+    else:
+        metrics.inc('fefe_llm_calls_saved_total', kind='stream')
+    async for token in stream.subscribe():
+        yield token
@@ -0,0 +1,213 @@
+from app.config import *
+from app.metrics import stage_timer, record_error
+import io
+
+discord_message_limit = 2000
+
+#############################################
+# Splitting long messages
+#############################################
+# Discord messages are limited to 2000 characters. `split_message` breaks text into chunks that
+# fit, preferring to break between paragraphs, then between lines. Lines that are too long on
+# their own are broken at the last space.
+# If a chunk ends inside a ``` code block, the block is closed at the end of the chunk and
+# reopened with the same language at the start of the next one, so every chunk renders properly.
+
+# Leave room on every line for closing and reopening a code fence.
+fence_overhead = 100
+
+def is_fence(line):
+    return line.strip().startswith('```')
+
+def split_long_line(line, max_length):
+    pieces = []
+    while len(line) > max_length:
+        cut = line.rfind(' ', 0, max_length)
+        if cut <= 0:
+            cut = max_length
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return pieces
+
+def split_message(text, limit=discord_message_limit):
+    lines = []
+    for line in text.split('\n'):
+        lines.extend(split_long_line(line, limit - fence_overhead))
+
+    # fences[i] is the opening fence line (e.g. '```python') of the code block that is open
+    # before line i, or None. fences[len(lines)] is the state after the last line.
+    fences = []
+    fence = None
+    for line in lines:
+        fences.append(fence)
+        if is_fence(line):
+            fence = None if fence is not None else line.strip()
+    fences.append(fence)
+
+    chunks = []
+    start = 0
+    while start < len(lines):
+        prefix = [fences[start]] if fences[start] else []
+        size = len('\n'.join(prefix))
+        end = start
+        # Take as many lines as fit, counting the closing fence the chunk would need.
+        while end < len(lines):
+            added = len(lines[end]) + (1 if size or end > start else 0)
+            closing = 4 if fences[end + 1] else 0
+            if size + added + closing > limit:
+                break
+            size += added
+            end += 1
+        if end == start:
+            end = start + 1
+        elif end < len(lines):
+            # Prefer to break after a blank line outside a code block, if that doesn't make the chunk too short.
+            for i in range(end - 1, start, -1):
+                if lines[i - 1].strip() == '' and fences[i] is None:
+                    if len('\n'.join(prefix + lines[start:i])) >= limit // 2:
+                        end = i
+                    break
+
+        chunk = '\n'.join(prefix + lines[start:end])
+        if fences[end]:
+            chunk += '\n```'
+        if chunk.strip():
+            chunks.append(chunk)
+        start = end
+    return chunks
+
+#############################################
+# Sending long messages
+#############################################
+# Every handler that posts model output goes through `send_chunks`.
+# Short text is sent as is. Longer text is split with `split_message` and the chunks are sent
+# back to back (Discord has no way to post several messages in one request, and sending them
+# concurrently could reorder them). Text that would take more than `discord_max_chunks` messages
+# is attached as a file instead, with the first chunk shown as a preview.
+async def send_chunks(ctx, text):
+    with stage_timer('discord_send'):
+        if len(text) <= discord_message_limit:
+            return await ctx.send(text)
+
+        chunks = split_message(text)
+        if len(chunks) > discord_max_chunks:
+            preview = chunks[0]
+            attachment = discord.File(io.BytesIO(text.encode('utf-8')), filename='response.md')
+            return await ctx.send(preview, file=attachment)
+
+        for chunk in chunks:
+            message = await ctx.send(chunk)
+        return message
+
+#############################################
+# Streaming replies
+#############################################
+# `StreamingMessage` posts a placeholder message as soon as a request starts and edits it
+# as tokens arrive from openAI. Edits are batched on a timer (`discord_stream_edit_interval`)
+# so we stay under Discord's message edit rate limits no matter how fast tokens come in.
+# The text is laid out with `split_message` on every flush: when it outgrows one message the
+# rest continues in a new one, and an unfinished code block is closed so it renders mid-stream.
+#
+# Usage:
+#     streamer = StreamingMessage(ctx)
+#     await streamer.start()
+#     async for token in stream_chat_completion(...):
+#         streamer.append(token)
+#     response_text = await streamer.finish()
+# Call `finish(failed=True)` if the stream raised.
+
+class StreamingMessage:
+    def __init__(self, ctx, placeholder='...', edit_interval=None):
+        self.ctx = ctx
+        self.placeholder = placeholder
+        self.edit_interval = edit_interval if edit_interval is not None else discord_stream_edit_interval
+        self.text = ''
+        # The Discord messages posted so far, and what each one currently shows.
+        self.messages = []
+        self.shown = []
+        self.done = False
+        self.changed = asyncio.Event()
+        self.flusher = None
+
+    async def start(self):
+        with stage_timer('discord_send'):
+            self.messages.append(await self.ctx.send(self.placeholder))
+        self.shown.append(self.placeholder)
+        self.flusher = asyncio.create_task(self._flush_loop())
+
+    # Appending never waits on Discord. The flusher picks the text up on its next tick.
+    def append(self, token):
+        self.text += token
+        self.changed.set()
+
+    # `failed` is set when the stream raised. The placeholder is never left showing '...': an
+    # empty answer or a failure replaces it with a message saying so.
+    # Discord errors are recorded rather than raised, so they can't hide the stream's own error
+    # or lose an answer that was already generated.
+    async def finish(self, failed=False):
+        self.done = True
+        self.changed.set()
+        if self.flusher is not None:
+            try:
+                await self.flusher
+            except Exception as e:
+                record_error('discord_edit', e)
+        await self._flush()
+        if not self.text:
+            await self._notice("Sorry, I couldn't get a response. Please try again." if failed else '(No response.)')
+        elif failed:
+            await self._send('(The response was cut off by an error.)')
+        return self.text
+
+    # Replace the placeholder, or post the text if the placeholder was never sent.
+    async def _notice(self, text):
+        if self.messages:
+            await self._edit(0, text)
+        else:
+            await self._send(text)
+
+    async def _flush_loop(self):
+        while not self.done:
+            await self.changed.wait()
+            self.changed.clear()
+            if self.done:
+                break
+            await self._flush()
+            await asyncio.sleep(self.edit_interval)
+
+    # A failed send or edit (e.g. a rate limit) is left for the next flush to retry, so one bad
+    # request doesn't stop the message from updating.
+    async def _flush(self):
+        for i, chunk in enumerate(split_message(self.text)):
+            if i >= len(self.messages):
+                sent = await self._send(chunk)
+            elif chunk != self.shown[i]:
+                sent = await self._edit(i, chunk)
+            else:
+                continue
+            # Later chunks would land in the wrong message without this one.
+            if not sent:
+                return
+
+    # Both return whether Discord accepted the request.
+    async def _send(self, text):
+        with stage_timer('discord_send'):
+            try:
+                message = await self.ctx.send(text)
+            except Exception as e:
+                record_error('discord_send', e)
+                return False
+        self.messages.append(message)
+        self.shown.append(text)
+        return True
+
+    async def _edit(self, index, text):
+        with stage_timer('discord_edit'):
+            try:
+                await self.messages[index].edit(content=text)
+            except Exception as e:
+                record_error('discord_edit', e)
+                return False
+        self.shown[index] = text
+        return True
@@ -0,0 +1,187 @@
+from app.config import *
+from bisect import bisect_left
+import time
+
+#############################################
+# Metrics
+#############################################
+# Per-stage timings and error counts, so a slow `!fefe` can be traced to the stage it spent
+# its time in (classify, SQLite, openAI, YouTube search, yt_dlp, Discord sends, the loops).
+#
+#     with stage_timer('youtube_search'):
+#         ...
+#
+# records the time in the `fefe_stage_seconds` histogram and counts an exception escaping the
+# block in `fefe_errors_total`. Errors handled in place are reported with `record_error(stage, e)`.
+# Recording is a couple of dictionary lookups and a bisect, cheap enough to leave on.
+#
+# The metrics are served in the Prometheus text format on http://`metrics_host`:`metrics_port`/metrics
+# and summarized by the admin `!stats` command.
+
+# Histogram buckets, in seconds.
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Estimate a quantile by interpolating inside the bucket it falls in.
+    def quantile(self, fraction):
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= target and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+        return self.buckets[-2]
+
+class Metrics:
+    def __init__(self):
+        # (name, labels) -> value, where labels is a sorted tuple of (key, value)
+        self.counters = {}
+        self.histograms = {}
+        # name -> function returning the current value, read when the metrics are rendered
+        self.gauges = {}
+        self.help = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(latency_buckets)
+        histogram.observe(value)
+
+    def register_gauge(self, name, function, help_text=''):
+        self.gauges[name] = function
+        self.help[name] = help_text
+
+    def render(self):
+        lines = []
+        for kind, names in (('counter', sorted(set(name for name, labels in self.counters))),
+                            ('histogram', sorted(set(name for name, labels in self.histograms)))):
+            for name in names:
+                lines.append(f'# TYPE {name} {kind}')
+                if kind == 'counter':
+                    for (counter_name, labels), value in sorted(self.counters.items()):
+                        if counter_name == name:
+                            lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                for (histogram_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        for name, function in sorted(self.gauges.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            if self.help[name]:
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    # A short plain text report for `!stats`.
+    def summary(self):
+        lines = [f"{'stage':<22} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'errors':>6}"]
+        errors = {}
+        for (name, labels), value in self.counters.items():
+            if name == 'fefe_errors_total':
+                stage = dict(labels)['stage']
+                errors[stage] = errors.get(stage, 0) + value
+        stages = {dict(labels)['stage']: histogram for (name, labels), histogram in self.histograms.items() if name == 'fefe_stage_seconds'}
+        for stage in sorted(set(stages) | set(errors)):
+            histogram = stages.get(stage, Histogram(latency_buckets))
+            lines.append(f"{stage:<22} {histogram.count:>7} {histogram.quantile(0.5) * 1000:>8.1f} "
+                         f"{histogram.quantile(0.95) * 1000:>8.1f} {errors.get(stage, 0):>6}")
+        others = [(name, labels, value) for (name, labels), value in sorted(self.counters.items()) if name != 'fefe_errors_total']
+        if others:
+            lines.append('')
+            for name, labels, value in others:
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        if self.gauges:
+            lines.append('')
+            for name, function in sorted(self.gauges.items()):
+                try:
+                    value = function()
+                except Exception:
+                    continue
+                lines.append(f'{name} {value:.3f}' if isinstance(value, float) else f'{name} {value}')
+        return '\n'.join(lines)
+
+# The process-wide registry.
+metrics = Metrics()
+
+class StageTimer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        metrics.observe('fefe_stage_seconds', time.perf_counter() - self.start, stage=self.stage)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            metrics.inc('fefe_errors_total', stage=self.stage, error=exc_type.__name__)
+        return False
+
+def stage_timer(stage):
+    return StageTimer(stage)
+
+# Count an error that was handled, and log it.
+def record_error(stage, error):
+    metrics.inc('fefe_errors_total', stage=stage, error=type(error).__name__)
+    print(f"Error in {stage}: {type(error).__name__}: {error}")
+
+#############################################
+# HTTP endpoint
+#############################################
+
+metrics_runner = None
+
+async def start_metrics_server():
+    global metrics_runner
+    if metrics_port is None or metrics_runner is not None:
+        return
+    from aiohttp import web
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, metrics_host, metrics_port).start()
@@ -0,0 +1,234 @@
+from app.config import *
+from app.audio_cache import audio_cache
+from app.metrics import stage_timer, record_error
+from collections import deque
+
+#############################################
+# Audio Sources
+#############################################
+#These are options for the youtube dl, not needed actually but are recommended
+ytdlopts = { 
+    # Prefer Opus audio, which can be sent to Discord without re-encoding (see `opus_passthrough`).
+    'format': 'bestaudio[acodec=opus]/bestaudio/best',
+    'outtmpl': os.path.join(audio_cache_directory, '%(extractor)s-%(id)s-%(title)s.%(ext)s'),
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0',  
+    'force-ipv4': True,
+    'preferredcodec': 'mp3',
+    'cachedir': False
+    
+    }
+
+ffmpeg_options = {
+        'options': '-vn'
+    }
+
+# Used when streaming (`youtube_stream_audio`). FFmpeg reads the audio straight from YouTube
+# and reconnects if the connection drops mid-song.
+ffmpeg_stream_options = {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+        'options': '-vn'
+    }
+
+# yt_dlp takes a while to import, so it is loaded the first time a song is requested.
+ytdl = None
+
+def get_ytdl():
+    global ytdl
+    if ytdl is None:
+        import yt_dlp
+        ytdl = yt_dlp.YoutubeDL(ytdlopts)
+    return ytdl
+
+# Download a song and return the path of the file. Blocking, so run it in a thread.
+def download_audio(video_url):
+    data = get_ytdl().extract_info(url=video_url, download=True)
+    if 'entries' in data:
+        data = data['entries'][0]
+    return get_ytdl().prepare_filename(data)
+
+
+# Work out what FFmpeg should play for a video: the cached file if we have one, otherwise the
+# stream URL (or a fresh download when `youtube_stream_audio` is off).
+# Returns (title, source, ffmpeg options, audio codec). The codec is None when it isn't known,
+# as for cached files. Only the yt_dlp lookup runs in a thread.
+async def resolve_audio(video_id, video_url, title):
+    cached_path = await audio_cache.lookup(video_id)
+    if cached_path is not None:
+        return title, cached_path, ffmpeg_options, None
+
+    loop = asyncio.get_running_loop()
+    with stage_timer('ytdl_extract'):
+        data = await loop.run_in_executor(None, lambda: get_ytdl().extract_info(url=video_url, download=not youtube_stream_audio))
+    if 'entries' in data: #checking if the url is a playlist or not
+        data = data['entries'][0] #if its a playlist, we get the first item of it
+    title = data.get('title', title)
+
+    if not youtube_stream_audio:
+        song = get_ytdl().prepare_filename(data) #the downloaded file
+        await audio_cache.add(video_id, song)
+        return title, song, ffmpeg_options, data.get('acodec')
+
+    # Popular songs are downloaded in the background so the next request plays from disk
+    if audio_cache.should_cache(video_id):
+        audio_cache.fetch_in_background(video_id, lambda: download_audio(video_url))
+    return title, data['url'], ffmpeg_stream_options, data.get('acodec')
+
+# Build the audio source for discord.py.
+# With `opus_passthrough`, FFmpeg hands discord.py Opus packets, so discord.py doesn't have to encode
+# every 20 ms frame itself. Opus audio (what YouTube usually serves) is only remuxed by FFmpeg, not
+# transcoded. Other codecs are encoded to Opus by FFmpeg, which is still cheaper than decoding to
+# PCM and encoding again in discord.py.
+async def create_audio_source(song, options, codec):
+    if not opus_passthrough:
+        return discord.FFmpegPCMAudio(source=song,**options, executable="ffmpeg")
+    if codec is None:
+        # Let ffprobe check whether the file can be copied as is.
+        return await discord.FFmpegOpusAudio.from_probe(song, **options, executable="ffmpeg")
+    return discord.FFmpegOpusAudio(song, codec='copy' if codec == 'opus' else None, **options, executable="ffmpeg")
+
+#############################################
+# Playback Queue
+#############################################
+# Each guild gets a `GuildPlayer` with its own queue of tracks. A new request while a song is
+# playing is queued instead of interrupting it. When a song ends, discord.py calls the `after`
+# callback from its audio thread, which schedules the next track on the event loop.
+#
+# While a song plays, the next track in the queue is resolved ahead of time (stream URL looked up,
+# or file downloaded), so the next song starts without a gap.
+# Queued and playing tracks are pinned in the audio cache so they can't be evicted.
+
+class Track:
+    def __init__(self, video_id, video_url, title, channel, requested_by):
+        self.video_id = video_id
+        self.video_url = video_url
+        self.title = title
+        # The text channel to announce the track in.
+        self.channel = channel
+        self.requested_by = requested_by
+        self.resolving = None
+
+    # Start resolving the audio without waiting for it.
+    def prefetch(self):
+        if self.resolving is None:
+            self.resolving = asyncio.ensure_future(resolve_audio(self.video_id, self.video_url, self.title))
+        return self.resolving
+
+    async def resolve(self):
+        return await self.prefetch()
+
+class GuildPlayer:
+    def __init__(self, guild):
+        self.guild = guild
+        self.queue = deque()
+        self.current = None
+        # True while `play_next` is resolving and starting a track.
+        self.starting = False
+        self.loop = asyncio.get_running_loop()
+
+    def is_active(self):
+        return self.current is not None
+
+    # True when a new track would start playing right away rather than wait in the queue.
+    def is_idle(self):
+        return self.current is None and not self.starting and not self.queue
+
+    # Add a track. Returns its position in the queue, or 0 if it starts playing right away.
+    async def enqueue(self, track):
+        audio_cache.pin(track.video_id)
+        self.queue.append(track)
+        # Only start playback when nothing is playing and no other call is already starting a
+        # track. Otherwise the track waits its turn.
+        if self.current is None and not self.starting:
+            await self.play_next()
+            return 0
+        if len(self.queue) == 1 and self.current is not None:
+            track.prefetch()
+        return len(self.queue)
+
+    async def play_next(self):
+        # Resolving a track takes seconds. Requests arriving in the meantime are queued by
+        # `enqueue` instead of starting a second `play_next`.
+        if self.starting:
+            return
+        self.starting = True
+        try:
+            await self._play_next()
+        finally:
+            self.starting = False
+
+    async def _play_next(self):
+        self.current = None
+        voice_client = self.guild.voice_client
+        while self.queue:
+            track = self.queue.popleft()
+            if voice_client is None or not voice_client.is_connected():
+                audio_cache.unpin(track.video_id)
+                continue
+            try:
+                title, song, options, codec = await track.resolve()
+                source = await create_audio_source(song, options, codec)
+                voice_client.play(source,
+                                  after=lambda error, track=track: self._after_playing(track, error)) #playing the audio
+            except Exception as e:
+                record_error('play', e)
+                audio_cache.unpin(track.video_id)
+                await track.channel.send(f"Couldn't play {track.title}. Skipping.")
+                continue
+            self.current = track
+            track.title = title
+            await track.channel.send(f"### Playing: {title}\n{track.video_url}")
+            # Get the next song ready while this one plays
+            if self.queue:
+                self.queue[0].prefetch()
+            return
+
+    # Called from discord.py's audio thread when a track finishes or is skipped.
+    def _after_playing(self, track, error):
+        if error:
+            record_error('play', error)
+        self.loop.call_soon_threadsafe(self._finished, track)
+
+    def _finished(self, track):
+        audio_cache.unpin(track.video_id)
+        if self.current is track:
+            self.loop.create_task(self.play_next())
+
+    def skip(self):
+        voice_client = self.guild.voice_client
+        if voice_client is not None and (voice_client.is_playing() or voice_client.is_paused()):
+            # Stopping triggers the `after` callback, which starts the next track.
+            voice_client.stop()
+            return True
+        return False
+
+    def clear(self):
+        for track in self.queue:
+            audio_cache.unpin(track.video_id)
+            if track.resolving is not None:
+                track.resolving.cancel()
+        self.queue.clear()
+
+    def stop(self):
+        self.clear()
+        self.current = None
+        voice_client = self.guild.voice_client
+        if voice_client is not None:
+            voice_client.stop()
+
+# guild id -> GuildPlayer
+players = {}
+
+def get_player(guild):
+    player = players.get(guild.id)
+    if player is None:
+        player = GuildPlayer(guild)
+        players[guild.id] = player
+    return player
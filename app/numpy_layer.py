@@ -0,0 +1,132 @@
+from app.config import *
+from app.training_data import load_training_data
+import re
+import zlib
+
+#############################################
+# NumPy Layer - Task Assignment
+#############################################
+# A lightweight alternative to the keras layer with the same `train`/`classify_prompt` interface.
+# Each message is turned into a bag of hashed features (words, word pairs and character
+# trigrams) and scored with a linear softmax model trained by full-batch gradient descent.
+# There is no TensorFlow import, training takes milliseconds and classifying a message is a
+# handful of array lookups.
+#
+# Select it by setting `classifier_backend = 'numpy'` in `app/config.py`.
+
+# Number of hashed feature buckets.
+numpy_feature_size = 2 ** 12
+# Gradient descent settings.
+numpy_iterations = 300
+numpy_learning_rate = 2.0
+numpy_l2 = 1e-4
+# Where `!retrain_keras` saves the model trained in the background process.
+numpy_model_file = os.path.join(keras_model_dir, 'numpy_model.npz')
+
+token_pattern = re.compile(r"[a-z0-9']+")
+
+# crc32 is used instead of `hash()` so features are stable across processes.
+def hash_feature(feature):
+    return zlib.crc32(feature.encode('utf-8')) % numpy_feature_size
+
+def extract_features(message):
+    words = token_pattern.findall(message.lower())
+    features = set('w:' + word for word in words)
+    features.update('b:' + first + ' ' + second for first, second in zip(words, words[1:]))
+    for word in words:
+        padded = '<' + word + '>'
+        features.update('c:' + padded[i:i + 3] for i in range(len(padded) - 2))
+    return sorted(set(hash_feature(feature) for feature in features))
+
+def vectorize(messages):
+    X = np.zeros((len(messages), numpy_feature_size), dtype=np.float32)
+    for i, message in enumerate(messages):
+        indices = extract_features(message)
+        if indices:
+            X[i, indices] = 1.0 / np.sqrt(len(indices))
+    return X
+
+class NumpyClassifier:
+    def __init__(self, weights, bias, labels):
+        self.weights = weights
+        self.bias = bias
+        self.labels = labels
+
+    @classmethod
+    def fit(cls, messages, labels):
+        label_to_index = {label: index for index, label in enumerate(keras_labels)}
+        X = vectorize(messages)
+        y = np.zeros((len(messages), len(keras_labels)), dtype=np.float32)
+        y[np.arange(len(messages)), [label_to_index[label] for label in labels]] = 1.0
+
+        weights = np.zeros((numpy_feature_size, len(keras_labels)), dtype=np.float32)
+        bias = np.zeros(len(keras_labels), dtype=np.float32)
+        for _ in range(numpy_iterations):
+            probabilities = softmax(X @ weights + bias)
+            error = (probabilities - y) / len(messages)
+            weights -= numpy_learning_rate * (X.T @ error + numpy_l2 * weights)
+            bias -= numpy_learning_rate * error.sum(axis=0)
+        return cls(weights, bias, list(keras_labels))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # np.savez adds '.npz' to names that don't already end in it, so keep the suffix on the temporary file.
+        temporary = path + '.tmp.npz'
+        np.savez(temporary, weights=self.weights, bias=self.bias, labels=np.array(self.labels))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            return cls(saved['weights'], saved['bias'], [str(label) for label in saved['labels']])
+
+    # Score a single message without building a dense feature vector.
+    def classify(self, message):
+        indices = extract_features(message)
+        scores = self.bias.copy()
+        if indices:
+            scores += self.weights[indices].sum(axis=0) / np.sqrt(len(indices))
+        return self.labels[int(np.argmax(scores))]
+
+    def predict(self, messages):
+        scores = vectorize(messages) @ self.weights + self.bias
+        return [self.labels[int(index)] for index in np.argmax(scores, axis=1)]
+
+def softmax(scores):
+    scores = scores - scores.max(axis=1, keepdims=True)
+    exp = np.exp(scores)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+classifier = None
+
+async def train_numpy():
+    messages, labels = load_training_data()
+    fit_numpy(messages, labels)
+
+def fit_numpy(messages, labels):
+    global classifier
+    classifier = NumpyClassifier.fit(messages, labels)
+
+############################################
+#  Background Retraining
+############################################
+# Same interface as the keras layer. `retrain` runs in the training process and saves the
+# fitted classifier; `install_retrained` loads it and swaps it in with a single assignment.
+def retrain(report):
+    messages, labels = load_training_data()
+    report(f"Training on {len(messages)} examples.")
+    NumpyClassifier.fit(messages, labels).save(numpy_model_file)
+    return numpy_model_file
+
+def install_retrained(path):
+    global classifier
+    classifier = NumpyClassifier.load(path)
+
+############################################
+#  Classification Function
+############################################
+def predict_labels(messages):
+    return classifier.predict(messages)
+
+async def classify_prompt(input_string):
+    return classifier.classify(input_string)
@@ -0,0 +1,57 @@
+from app.config import *
+from collections import OrderedDict, deque
+
+#############################################
+# Conversation history cache
+#############################################
+# Keeps the most recent turns of each channel in memory so `fetch_prompts` never has to
+# query SQLite on the hot path. Each channel gets a ring buffer of `prompt_history_cache_size`
+# (prompt, response, prompt_tokens, response_tokens) turns. `store_prompt` writes every new turn through to the cache.
+#
+# A channel is read from the `prompts` table the first time it is needed after startup.
+# At most `prompt_history_channels` channels are kept; the least recently used one is
+# dropped first and simply reloaded from the table if it becomes active again.
+
+class PromptHistory:
+    def __init__(self, turns=None, channels=None):
+        self.turns = turns or prompt_history_cache_size
+        self.max_channels = channels or prompt_history_channels
+        self.channels = OrderedDict()
+
+    def __contains__(self, channel_id):
+        return str(channel_id) in self.channels
+
+    # Rows must be ordered oldest to newest.
+    def load(self, channel_id, rows):
+        self.channels[str(channel_id)] = deque((tuple(row) for row in rows), maxlen=self.turns)
+        self._touch(str(channel_id))
+
+    def append(self, channel_id, prompt, response, prompt_tokens, response_tokens):
+        # Channels we haven't loaded yet are left alone. They are read from the table in full when first needed.
+        history = self.channels.get(str(channel_id))
+        if history is not None:
+            history.append((prompt, response, prompt_tokens, response_tokens))
+            self._touch(str(channel_id))
+
+    # Returns up to `limit` of the most recent turns, oldest first.
+    def recent(self, channel_id, limit):
+        history = self.channels.get(str(channel_id), ())
+        self._touch(str(channel_id))
+        if limit <= 0:
+            return []
+        if limit >= len(history):
+            return list(history)
+        return list(history)[-limit:]
+
+    # Drop a channel so it is read from the table again the next time it is needed.
+    def forget(self, channel_id):
+        self.channels.pop(str(channel_id), None)
+
+    def _touch(self, channel_id):
+        if channel_id in self.channels:
+            self.channels.move_to_end(channel_id)
+            while len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+
+# The process-wide history cache.
+prompt_history = PromptHistory()
@@ -0,0 +1,106 @@
+from app.config import *
+from app.database import get_db
+import gzip
+
+#############################################
+# Prompt Retention
+#############################################
+# Keeps the `prompts` table from growing without bound. Run from the maintenance loop in bot.py.
+#
+# - Globally, only the `prompt_table_cache_size` newest ids are kept. `MAX(id)` is read off the
+#   end of the primary key and everything at or below `MAX(id) - prompt_table_cache_size` goes,
+#   so each run only touches the rows it deletes, no matter how big the table is allowed to get.
+# - With `prompt_channel_cache_size` set, each channel also keeps only its newest rows. Only
+#   channels that were written to since the last run are checked, using the (channel_id, id) index.
+# - With `prompt_archive_file` set, trimmed rows are appended to that gzipped JSONL file before
+#   they are deleted.
+# - With `conversation_summaries_enabled`, a channel's newest
+#   `conversation_summary_raw_turns + conversation_summary_every` rows are kept while its summary
+#   doesn't cover them yet, so a quiet channel's last turns aren't lost before the summarizer folds
+#   them in. That is the most a channel waits before a refresh, so it bounds what is kept beyond
+#   the limits above. Rows without a channel_id (written before channels were recorded) are never kept.
+#   Kept rows below the global cutoff are only checked again when their channel is touched, so a
+#   run never rescans them.
+
+# Rows in their channel's window of turns the summary doesn't cover yet. Both lookups use an index:
+# the channel_summaries primary key and (channel_id, id) on prompts.
+unsummarized_clause = (
+    'channel_id IS NOT NULL'
+    ' AND id > COALESCE((SELECT last_prompt_id FROM channel_summaries WHERE channel_summaries.channel_id = prompts.channel_id), 0)'
+    ' AND id > COALESCE((SELECT newer.id FROM prompts AS newer WHERE newer.channel_id = prompts.channel_id ORDER BY newer.id DESC LIMIT 1 OFFSET ?), 0)'
+)
+
+prompt_columns = ['id', 'username', 'prompt', 'model', 'response', 'channel_id', 'channel_name', 'keras_classified_as', 'timestamp', 'prompt_tokens', 'response_tokens']
+
+def archive_rows(path, rows):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Each append adds a new gzip member; gzip readers treat the file as one stream.
+    with gzip.open(path, 'at', encoding='utf-8') as archive:
+        for row in rows:
+            archive.write(json.dumps(dict(row)) + '\n')
+
+class PromptRetention:
+    def __init__(self, max_rows=None, channel_max_rows=None, archive_file=None):
+        self.max_rows = max_rows if max_rows is not None else prompt_table_cache_size
+        self.channel_max_rows = channel_max_rows if channel_max_rows is not None else prompt_channel_cache_size
+        self.archive_file = archive_file if archive_file is not None else prompt_archive_file
+        self.keep_unsummarized = conversation_summaries_enabled
+        self.unsummarized_window = conversation_summary_raw_turns + conversation_summary_every
+        self.dirty_channels = set()
+        # Everything at or below this id has been trimmed, apart from kept unsummarized rows.
+        self.trimmed_to = None
+        self.next_trimmed_to = None
+
+    # Called by `store_prompt` for every new row, and when a channel's summary moves forward.
+    def touch(self, channel_id):
+        if self.channel_max_rows or self.keep_unsummarized:
+            self.dirty_channels.add(str(channel_id))
+
+    # Returns a list of (where clause, params) selecting the rows to trim.
+    async def cutoffs(self, db):
+        cutoffs = []
+        channels = self.dirty_channels
+        self.dirty_channels = set()
+        self.next_trimmed_to = self.trimmed_to
+        if self.max_rows:
+            row = await db.fetchone('SELECT MAX(id) FROM prompts')
+            if row[0] is not None and row[0] > self.max_rows:
+                cutoff = row[0] - self.max_rows
+                if self.trimmed_to is None:
+                    cutoffs.append(('id <= ?', (cutoff,)))
+                elif cutoff > self.trimmed_to:
+                    cutoffs.append(('id > ? AND id <= ?', (self.trimmed_to, cutoff)))
+                self.next_trimmed_to = max(cutoff, self.trimmed_to or 0)
+            # Rows kept below the cutoff by an earlier run may have left their channel's window.
+            if self.keep_unsummarized and self.trimmed_to is not None:
+                for channel_id in channels:
+                    cutoffs.append(('channel_id = ? AND id <= ?', (channel_id, self.trimmed_to)))
+
+        if self.channel_max_rows:
+            for channel_id in channels:
+                # The newest row this channel no longer keeps, if any.
+                row = await db.fetchone('SELECT id FROM prompts WHERE channel_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+                                        (channel_id, self.channel_max_rows))
+                if row is not None:
+                    cutoffs.append(('channel_id = ? AND id <= ?', (channel_id, row[0])))
+        return cutoffs
+
+    async def run(self):
+        db = await get_db()
+        for where, params in await self.cutoffs(db):
+            if self.keep_unsummarized:
+                where = f'{where} AND NOT ({unsummarized_clause})'
+                params = params + (self.unsummarized_window,)
+            if self.archive_file:
+                rows = await db.fetchall(f"SELECT {', '.join(prompt_columns)} FROM prompts WHERE {where} ORDER BY id", params)
+                if not rows:
+                    continue
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, archive_rows, self.archive_file, rows)
+            await db.execute(f'DELETE FROM prompts WHERE {where}', params)
+        self.trimmed_to = self.next_trimmed_to
+
+# The process-wide retention policy.
+prompt_retention = PromptRetention()
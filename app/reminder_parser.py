@@ -0,0 +1,219 @@
+from app.config import *
+from app.metrics import metrics
+from collections import Counter
+import re
+
+#############################################
+# Reminder time parser
+#############################################
+# Most reminders follow a handful of patterns, like "in 30 minutes", "tomorrow at 9am" or
+# "next monday morning". `parse_reminder` handles those locally, in microseconds, and returns
+# (reminder text, due datetime). It returns None when it isn't sure, and `set_reminder` then
+# falls back to asking openAI.
+#
+# The parser pulls out the pieces it understands (a relative offset, a day, a part of the day,
+# a clock time, a date) and removes them from the message. If anything time-like is left over,
+# e.g. "every friday" or "at 5", the message is handed to the model instead of guessing.
+#
+# `reminder_parser_stats` counts how reminders were parsed: 'fast' (broken down by which pieces
+# matched), 'llm' and 'failed'. The same counts are exported as `fefe_reminder_parses_total`.
+
+reminder_parser_stats = Counter()
+
+def count_parse(result):
+    reminder_parser_stats[result] += 1
+    metrics.inc('fefe_reminder_parses_total', result=result)
+
+number_words = {
+    'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7,
+    'eight': 8, 'nine': 9, 'ten': 10, 'eleven': 11, 'twelve': 12, 'fifteen': 15, 'twenty': 20,
+    'thirty': 30, 'forty': 40, 'forty-five': 45, 'fifty': 50, 'sixty': 60, 'ninety': 90,
+}
+unit_seconds = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+months = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august',
+          'september', 'october', 'november', 'december']
+# Default hour for "in the morning", "tonight", etc.
+day_part_hours = {'morning': 9, 'afternoon': 15, 'evening': 18, 'night': 21, 'tonight': 21}
+# Hour used for a day or date given without a time, e.g. "on friday".
+default_hour = 9
+
+number = r'(\d+|' + '|'.join(sorted(number_words, key=len, reverse=True)) + r')'
+unit = r'(sec(?:ond)?s?|min(?:ute)?s?|h(?:ou)?rs?|hours?|days?|weeks?)'
+relative_pattern = re.compile(rf'\bin\s+(?:(half\s+an?\s+hour)|{number}\s+{unit}(?:\s+and\s+{number}\s+{unit})?|{number}\s+and\s+a\s+half\s+{unit})\b', re.IGNORECASE)
+clock_pattern = re.compile(r'\b(?:at\s+)?(?:(noon|midnight)|(\d{1,2})(?::(\d{2}))?\s*([ap])\.?m\.?|(\d{1,2}):(\d{2}))(?=\W|$)', re.IGNORECASE)
+day_pattern = re.compile(r'\b(today|tonight|tomorrow|next\s+week|(?:on\s+|next\s+|this\s+)?(?:' + '|'.join(weekdays) + r'))\b', re.IGNORECASE)
+part_pattern = re.compile(r'\b(?:in\s+the\s+|this\s+|at\s+)?(morning|afternoon|evening|night)\b', re.IGNORECASE)
+date_pattern = re.compile(r'\b(?:on\s+)?(?:(\d{4})-(\d{2})-(\d{2})|(' + '|'.join(months) + r')\s+(\d{1,2})(?:st|nd|rd|th)?)\b', re.IGNORECASE)
+
+# Anything like this left in the message means there's a time expression we didn't understand.
+leftover_time_pattern = re.compile(r'\b(\d{1,2}(:\d{2})?\s*[ap]\.?m\b|\d{1,2}:\d{2}|at\s+\d+|o\'?clock|noon|midnight|'
+                                   r'seconds?|minutes?|mins?|hours?|hrs?|days?|weeks?|months?|years?|'
+                                   r'today|tonight|tomorrow|yesterday|morning|afternoon|evening|night|'
+                                   r'every|daily|weekly|monthly|next|later|before|after|until|'
+                                   + '|'.join(weekdays) + '|' + '|'.join(months) + r')\b', re.IGNORECASE)
+# Phrases around the reminder text that aren't part of it.
+lead_pattern = re.compile(r'^\W*(?:(?:hey\s+)?fefe\W*)?(?:(?:can|could|would)\s+you\s+)?(?:please\s+)?(?:set\s+a\s+reminder|remind\s+(?:me|us))?\W*(?:(?:to|that|about|of)\b)?\W*', re.IGNORECASE)
+trail_pattern = re.compile(r'\W*\b(?:to|at|on|about|please)?\W*$', re.IGNORECASE)
+
+def to_number(text):
+    text = text.lower()
+    return int(text) if text.isdigit() else number_words[text]
+
+def unit_to_seconds(text):
+    text = text.lower()
+    return unit_seconds['h' if text.startswith('h') else text[0]]
+
+def extract(pattern, text):
+    match = pattern.search(text)
+    if match is None:
+        return None, text
+    return match, (text[:match.start()] + ' ' + text[match.end():])
+
+def clean_reminder_text(text):
+    text = ' '.join(text.split())
+    text = lead_pattern.sub('', text, count=1)
+    text = trail_pattern.sub('', text, count=1)
+    text = ' '.join(text.split())
+    return text[:1].upper() + text[1:]
+
+# Returns (hour, minute) for a clock time match.
+def clock_time(match):
+    named, hour, minute, meridiem, hour24, minute24 = match.groups()
+    if named:
+        return (12, 0) if named.lower() == 'noon' else (0, 0)
+    if hour24:
+        hour, minute = int(hour24), int(minute24)
+        if hour > 23 or minute > 59:
+            raise ValueError(match.group(0))
+        return hour, minute
+    hour, minute = int(hour), int(minute or 0)
+    if not 1 <= hour <= 12 or minute > 59:
+        raise ValueError(match.group(0))
+    hour = hour % 12 + (12 if meridiem.lower() == 'p' else 0)
+    return hour, minute
+
+def next_weekday(now, weekday):
+    days = (weekday - now.weekday()) % 7
+    return now + timedelta(days=days or 7)
+
+# Returns (reminder text, due datetime) or None.
+def parse_reminder(message, now=None):
+    now = (now or datetime.now()).replace(microsecond=0)
+    text = message
+    relative, text = extract(relative_pattern, text)
+    date, text = extract(date_pattern, text)
+    day, text = extract(day_pattern, text)
+    clock, text = extract(clock_pattern, text)
+    part, text = extract(part_pattern, text)
+    if leftover_time_pattern.search(text):
+        return None
+    if not (relative or date or day or clock or part):
+        return None
+
+    try:
+        time_of_day = clock_time(clock) if clock else None
+    except ValueError:
+        return None
+    if time_of_day is None and part:
+        time_of_day = (day_part_hours[part.group(1).lower()], 0)
+
+    if relative:
+        if date or day:
+            return None
+        half_hour, count, count_unit, count2, count_unit2, half_count, half_unit = relative.groups()
+        if half_hour:
+            seconds = 30 * 60
+        elif half_count:
+            seconds = (to_number(half_count) + 0.5) * unit_to_seconds(half_unit)
+        else:
+            seconds = to_number(count) * unit_to_seconds(count_unit)
+            if count2:
+                seconds += to_number(count2) * unit_to_seconds(count_unit2)
+        due = now + timedelta(seconds=seconds)
+        # "in 2 days at 9am" moves to that time of day. Shorter offsets can't also have a time.
+        if time_of_day is not None:
+            if seconds < unit_seconds['d']:
+                return None
+            due = due.replace(hour=time_of_day[0], minute=time_of_day[1], second=0)
+        pieces = 'relative'
+    elif date:
+        year, month_number, day_number, month_name, month_day = date.groups()
+        if day:
+            return None
+        try:
+            if year:
+                due = datetime(int(year), int(month_number), int(day_number))
+            else:
+                due = datetime(now.year, months.index(month_name.lower()) + 1, int(month_day))
+                if due.date() < now.date():
+                    due = due.replace(year=now.year + 1)
+        except ValueError:
+            return None
+        hour, minute = time_of_day if time_of_day is not None else (default_hour, 0)
+        due = due.replace(hour=hour, minute=minute)
+        pieces = 'date'
+    elif day:
+        word = ' '.join(day.group(1).lower().split())
+        if word.startswith(('on ', 'this ', 'next ')) and word != 'next week':
+            word = word.split(' ', 1)[1]
+        if word == 'today':
+            due = now
+        elif word == 'tonight':
+            due = now
+            time_of_day = time_of_day or (day_part_hours['tonight'], 0)
+        elif word == 'tomorrow':
+            due = now + timedelta(days=1)
+        elif word == 'next week':
+            due = now + timedelta(weeks=1)
+        else:
+            due = next_weekday(now, weekdays.index(word))
+            time_of_day = time_of_day or (default_hour, 0)
+        if time_of_day is not None:
+            due = due.replace(hour=time_of_day[0], minute=time_of_day[1], second=0)
+        pieces = 'day'
+    else:
+        # Just a time: today if it's still ahead, otherwise tomorrow.
+        due = now.replace(hour=time_of_day[0], minute=time_of_day[1], second=0)
+        if due <= now:
+            due += timedelta(days=1)
+        pieces = 'time'
+
+    if due <= now:
+        return None
+    reminder_text = clean_reminder_text(text) or 'Reminder'
+    count_parse(f'fast:{pieces}')
+    return reminder_text, due
+
+# Share of parsed reminders that took the fast path.
+def reminder_parser_hit_rate():
+    fast = sum(count for key, count in reminder_parser_stats.items() if key.startswith('fast'))
+    total = fast + reminder_parser_stats['llm']
+    return fast / total if total else 0.0
+
+metrics.register_gauge('fefe_reminder_parser_hit_rate', reminder_parser_hit_rate, 'Share of reminders parsed without openAI')
+
+# Known phrasings, checked with `python -m app.reminder_parser`. None means the model should handle it.
+examples = [
+    ('remind me in 30 minutes to call mom', 'Call mom', datetime(2024, 5, 6, 15, 0)),
+    ('remind me tomorrow at 9am to submit the report', 'Submit the report', datetime(2024, 5, 7, 9, 0)),
+    ('remind me on friday at 5pm to water the plants', 'Water the plants', datetime(2024, 5, 10, 17, 0)),
+    ('remind me at 5 to stretch', None, None),
+    ('remind me to call at 10 tomorrow', None, None),
+    ('remind me to email at 10 in the morning', None, None),
+    ('remind me on friday at 10 to x', None, None),
+    ('remind me every friday to clean', None, None),
+]
+
+if __name__ == '__main__':
+    # A Monday afternoon.
+    now = datetime(2024, 5, 6, 14, 30)
+    failures = 0
+    for message, text, due in examples:
+        expected = None if text is None else (text, due)
+        parsed = parse_reminder(message, now)
+        if parsed != expected:
+            failures += 1
+            print(f'{message!r}: expected {expected}, got {parsed}')
+    print(f'{len(examples) - failures}/{len(examples)} reminder phrasings parsed as expected')
+    raise SystemExit(1 if failures else 0)
@@ -0,0 +1,105 @@
+from app.config import *
+from app.metrics import stage_timer, record_error
+import heapq
+
+#############################################
+# Reminder Scheduler
+#############################################
+# Keeps every pending reminder in a min-heap ordered by due time, mirroring the `reminders`
+# table. The heap is loaded once at startup and kept in sync by `add_reminder`,
+# `delete_reminder` and `clear_user_reminders` in `app/bot_functions.py`.
+#
+# Instead of polling the table every minute, the scheduler sleeps until the earliest
+# reminder is due. Adding a reminder that is due sooner wakes it up early.
+
+reminder_time_format = "%Y-%m-%d %H:%M:%S"
+
+# Reminder times are stored as text in the table. Parse them once, when they enter the heap.
+def parse_reminder_time(reminder_time):
+    if isinstance(reminder_time, datetime):
+        return reminder_time
+    try:
+        return datetime.strptime(reminder_time, reminder_time_format)
+    except ValueError:
+        return datetime.fromisoformat(reminder_time)
+
+class ReminderScheduler:
+    # Never sleep longer than this, so a change to the system clock can't delay reminders for long.
+    max_sleep = 300
+
+    def __init__(self):
+        # Entries are (due time, reminder id, username, reminder text, channel id)
+        self.heap = []
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def load(self, rows):
+        self.heap = []
+        for reminder_id, username, reminder, channel_id, reminder_time in rows:
+            try:
+                due = parse_reminder_time(reminder_time)
+            except (TypeError, ValueError):
+                print(f"Skipping reminder {reminder_id} with unreadable time: {reminder_time}")
+                continue
+            self.heap.append((due, reminder_id, username, reminder, channel_id))
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    def add(self, reminder_id, username, reminder, channel_id, reminder_time):
+        entry = (parse_reminder_time(reminder_time), reminder_id, username, reminder, channel_id)
+        heapq.heappush(self.heap, entry)
+        # Only wake the loop if the new reminder is now the next one due.
+        if self.heap[0] is entry:
+            self.wakeup.set()
+
+    def remove(self, reminder_id):
+        self._remove_where(lambda entry: entry[1] == reminder_id)
+
+    def remove_user(self, username):
+        self._remove_where(lambda entry: entry[2] == username)
+
+    def _remove_where(self, predicate):
+        self.heap = [entry for entry in self.heap if not predicate(entry)]
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    # Pop every reminder whose time has come.
+    def pop_due(self, now=None):
+        now = now or datetime.now()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap))
+        return due
+
+    def seconds_until_next(self, now=None):
+        if not self.heap:
+            return None
+        now = now or datetime.now()
+        return max(0, min((self.heap[0][0] - now).total_seconds(), self.max_sleep))
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    # `send` is called with the list of due heap entries, e.g. `send_reminders(bot, due)`.
+    def start(self, send):
+        if not self.running():
+            self.task = asyncio.create_task(self._run(send))
+
+    async def _run(self, send):
+        while True:
+            self.wakeup.clear()
+            due = self.pop_due()
+            if due:
+                with stage_timer('send_reminders'):
+                    try:
+                        await send(due)
+                    except Exception as e:
+                        record_error('send_reminders', e)
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.seconds_until_next())
+            except asyncio.TimeoutError:
+                pass
+
+# The process-wide scheduler.
+reminder_scheduler = ReminderScheduler()
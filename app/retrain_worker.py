@@ -0,0 +1,35 @@
+from app.config import *
+import sys
+
+#############################################
+# Retraining Worker
+#############################################
+# `retrain_classifier` in `app/classifier.py` runs this module in a separate Python process:
+#     python -m app.retrain_worker <backend>
+# It trains the model, saves it to disk and writes its progress to stdout as JSON lines.
+# A separate interpreter (rather than multiprocessing) keeps the child from re-running bot.py
+# or inheriting the bot's threads and connections.
+
+progress_prefix = 'RETRAIN '
+
+def write_line(**payload):
+    print(progress_prefix + json.dumps(payload), flush=True)
+
+def report_progress(message):
+    write_line(progress=message)
+
+# Train with the given backend and return whatever its `install_retrained` expects.
+def run_retrain(backend):
+    if backend == 'numpy':
+        from app.numpy_layer import retrain
+    else:
+        from app.keras_layer import retrain
+    return retrain(report_progress)
+
+if __name__ == '__main__':
+    backend = sys.argv[1] if len(sys.argv) > 1 else classifier_backend
+    try:
+        write_line(result=run_retrain(backend))
+    except Exception as e:
+        write_line(error=f"{type(e).__name__}: {e}")
+        sys.exit(1)
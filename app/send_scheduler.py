@@ -0,0 +1,108 @@
+from app.config import *
+from app.message_sender import discord_message_limit
+from app.metrics import metrics, stage_timer
+from collections import deque
+import time
+
+#############################################
+# Outbound Send Scheduler
+#############################################
+# Messages the bot posts on its own (like reminders) go through `outbound.send(channel, text)`
+# instead of `channel.send`.
+#
+# - Each channel has its own queue and worker, so a slow or rate limited channel doesn't hold up
+#   the others.
+# - Messages that pile up for the same channel are merged into as few messages as fit in
+#   Discord's 2000 character limit, e.g. everyone's 9am reminders go out as one message.
+# - Sends are paced with token buckets that follow Discord's rate limits: a burst of
+#   `discord_channel_burst` messages per channel refilled at `discord_channel_rate` per second,
+#   and `discord_global_rate` messages per second across the whole bot.
+
+class TokenBucket:
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Merge queued texts into as few messages as possible. Returns [(content, [futures]), ...].
+# A text that is too long on its own is sent by itself.
+def coalesce(pending):
+    batches = []
+    content = None
+    futures = []
+    for text, future in pending:
+        if content is not None and len(content) + 1 + len(text) <= discord_message_limit:
+            content += '\n' + text
+            futures.append(future)
+            continue
+        if content is not None:
+            batches.append((content, futures))
+        content = text
+        futures = [future]
+    if content is not None:
+        batches.append((content, futures))
+    return batches
+
+class OutboundScheduler:
+    def __init__(self):
+        # channel id -> deque of (text, future)
+        self.queues = {}
+        self.workers = {}
+        self.buckets = {}
+        self.global_bucket = None
+
+    # Queue a message for the channel. Returns once it has been sent (possibly merged with others).
+    async def send(self, channel, text):
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(channel.id, deque()).append((text, future))
+        if channel.id not in self.workers:
+            self.workers[channel.id] = asyncio.create_task(self._run(channel))
+        return await future
+
+    async def _run(self, channel):
+        if self.global_bucket is None:
+            self.global_bucket = TokenBucket(discord_global_rate, discord_global_rate)
+        bucket = self.buckets.setdefault(channel.id, TokenBucket(discord_channel_burst, discord_channel_rate))
+        queue = self.queues[channel.id]
+        try:
+            while queue:
+                # Wait for our turn before taking messages off the queue, so anything that arrives
+                # in the meantime is merged into this send.
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+                pending = list(queue)
+                content, futures = coalesce(pending)[0]
+                # Whatever didn't fit in this message stays queued for the next send.
+                for _ in futures:
+                    queue.popleft()
+                # Texts merged into another message count as saved sends.
+                metrics.inc('fefe_outbound_coalesced_total', len(futures) - 1)
+                try:
+                    with stage_timer('discord_send'):
+                        await channel.send(content)
+                except Exception as e:
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for future in futures:
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            del self.workers[channel.id]
+            if not queue:
+                del self.queues[channel.id]
+
+# The process-wide scheduler.
+outbound = OutboundScheduler()
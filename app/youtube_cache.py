@@ -0,0 +1,76 @@
+from app.config import *
+from app.database import get_db
+from collections import OrderedDict
+import time
+
+#############################################
+# YouTube Cache
+#############################################
+# Every music request costs an openAI round trip (message -> search query) and a YouTube Data API
+# search (search query -> video), and the search eats into the daily API quota. Both results are
+# cached with a time to live:
+#     'query'   normalized message text -> search query     (`youtube_query_cache_ttl`)
+#     'search'  normalized search query -> video id + title (`youtube_search_cache_ttl`)
+# Entries live in the `youtube_cache` table so they survive restarts, with an in-memory LRU
+# of `youtube_cache_memory_size` entries in front of it.
+
+def normalize_key(text):
+    return ' '.join(text.lower().split())
+
+async def create_youtube_cache_table():
+    db = await get_db()
+    await db.execute('''CREATE TABLE IF NOT EXISTS youtube_cache
+                  (kind TEXT NOT NULL,
+                  key TEXT NOT NULL,
+                  value TEXT NOT NULL,
+                  expires_at REAL NOT NULL,
+                  PRIMARY KEY (kind, key))''')
+    # `purge_expired` runs every minute, so it looks expired rows up by index instead of scanning the table.
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_youtube_cache_expires_at ON youtube_cache (expires_at)')
+
+class YoutubeCache:
+    def __init__(self, memory_size=None):
+        self.memory_size = memory_size or youtube_cache_memory_size
+        self.memory = OrderedDict()
+
+    async def get(self, kind, key):
+        cache_key = (kind, normalize_key(key))
+        now = time.time()
+        entry = self.memory.get(cache_key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > now:
+                self.memory.move_to_end(cache_key)
+                return value
+            del self.memory[cache_key]
+
+        db = await get_db()
+        row = await db.fetchone('SELECT value, expires_at FROM youtube_cache WHERE kind = ? AND key = ? AND expires_at > ?',
+                                (cache_key[0], cache_key[1], now))
+        if row is None:
+            return None
+        value = json.loads(row['value'])
+        self._remember(cache_key, value, row['expires_at'])
+        return value
+
+    async def set(self, kind, key, value, ttl):
+        cache_key = (kind, normalize_key(key))
+        expires_at = time.time() + ttl
+        self._remember(cache_key, value, expires_at)
+        db = await get_db()
+        await db.execute('INSERT OR REPLACE INTO youtube_cache (kind, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                         (cache_key[0], cache_key[1], json.dumps(value), expires_at))
+
+    def _remember(self, cache_key, value, expires_at):
+        self.memory[cache_key] = (value, expires_at)
+        self.memory.move_to_end(cache_key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    # Delete expired rows. Run from the maintenance loop in bot.py.
+    async def purge_expired(self):
+        db = await get_db()
+        await db.execute('DELETE FROM youtube_cache WHERE expires_at <= ?', (time.time(),))
+
+# The process-wide cache.
+youtube_cache = YoutubeCache()
@@ -0,0 +1,102 @@
+# Compares the keras and numpy classifier backends on the bot's training data.
+#
+# Accuracy is measured with stratified k-fold cross validation over the seed examples plus
+# every row in `labeled_prompts`. Latency is the time to train on the full data set and
+# the time of a single `classify_prompt` call.
+#
+# Run from the repository root:
+#     python benchmarks/compare_classifiers.py [--folds 5] [--backends numpy keras]
+#
+# The keras backend is skipped if TensorFlow isn't installed.
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import *
+from app.training_data import load_training_data
+
+def load_backend(name):
+    if name == 'numpy':
+        import app.numpy_layer as backend
+        return backend.fit_numpy, backend.classify_prompt
+    import app.keras_layer as backend
+    def fit(messages, labels):
+        backend.current_model = backend.fit_keras(messages, labels, verbose=0)
+    return fit, backend.classify_prompt
+
+def stratified_folds(labels, folds, seed=0):
+    by_label = {}
+    for index, label in enumerate(labels):
+        by_label.setdefault(label, []).append(index)
+    assignment = [0] * len(labels)
+    rng = random.Random(seed)
+    for indices in by_label.values():
+        rng.shuffle(indices)
+        for position, index in enumerate(indices):
+            assignment[index] = position % folds
+    return assignment
+
+async def safe_classify(classify, message):
+    try:
+        return await classify(message)
+    except Exception:
+        # The keras layer fails on messages longer than anything it was trained on.
+        return None
+
+async def evaluate(name, messages, labels, folds):
+    fit, classify = load_backend(name)
+
+    assignment = stratified_folds(labels, folds)
+    correct = 0
+    for fold in range(folds):
+        train = [i for i in range(len(messages)) if assignment[i] != fold]
+        test = [i for i in range(len(messages)) if assignment[i] == fold]
+        fit([messages[i] for i in train], [labels[i] for i in train])
+        for i in test:
+            if await safe_classify(classify, messages[i]) == labels[i]:
+                correct += 1
+
+    start = time.perf_counter()
+    fit(messages, labels)
+    train_seconds = time.perf_counter() - start
+
+    timings = []
+    for _ in range(5):
+        for message in messages:
+            start = time.perf_counter()
+            await safe_classify(classify, message)
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    return {'backend': name,
+            'accuracy': correct / len(messages),
+            'train_s': train_seconds,
+            'p50_us': statistics.median(timings) * 1e6,
+            'p95_us': timings[int(len(timings) * 0.95)] * 1e6}
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--backends', nargs='+', default=['numpy', 'keras'])
+    args = parser.parse_args()
+
+    messages, labels = load_training_data()
+    print(f"{len(messages)} examples, {args.folds}-fold cross validation\n")
+    print(f"{'backend':<8} {'accuracy':>9} {'train (s)':>10} {'p50 (us)':>10} {'p95 (us)':>10}")
+    for name in args.backends:
+        try:
+            result = await evaluate(name, messages, labels, args.folds)
+        except ImportError as e:
+            print(f"{name:<8} skipped ({e})")
+            continue
+        print(f"{result['backend']:<8} {result['accuracy']:>9.1%} {result['train_s']:>10.3f} "
+              f"{result['p50_us']:>10.1f} {result['p95_us']:>10.1f}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
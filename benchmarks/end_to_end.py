@@ -0,0 +1,429 @@
+# Measures the bot end to end without Discord, openAI or YouTube, so performance changes can be
+# compared against a baseline on any Linux box.
+#
+# Stand-ins:
+#   openAI   a local aiohttp server speaking the chat completions API, with a configurable delay
+#            before the first token and between tokens, and SSE streaming. `openai.api_base` points at it,
+#            so requests go through the real client and HTTP stack.
+#   YouTube  a fake Data API client (`search().list().execute()`) and a fake yt_dlp, each with a delay.
+#   Discord  fake ctx, channels, messages, guilds and voice clients. Sends and edits take `--discord-latency`.
+#            "Playing" a song just waits `--song-seconds` before calling discord.py's `after` callback.
+#
+# Scenarios:
+#   other, reminder, youtube   `talk_to_fefe` with messages of that label from the training data
+#   send_reminders             `--reminders` due reminders spread over `--channels` channels
+#   train                      `train_keras` from scratch, `--train-runs` times
+#
+# Every message gets a unique suffix so the caches start cold; pass `--repeat-messages` to measure warm caches.
+# Everything runs against a temporary database. Run from the repository root:
+#     python benchmarks/end_to_end.py [--requests 200] [--concurrency 20] [--backend numpy]
+#     python benchmarks/end_to_end.py --scenarios other --stream --llm-latency 0.5 --llm-tokens 200
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+#############################################
+# openAI stand-in
+#############################################
+
+class FakeOpenAI:
+    def __init__(self, latency, tokens, token_interval):
+        self.latency = latency
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/v1'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def completion(self, body):
+        if body.get('functions'):
+            # The reminder fallback asks for a set_reminder call.
+            due = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() + 3600))
+            arguments = json.dumps({'message': 'Benchmark reminder', 'reminder_time': due})
+            return {'role': 'assistant', 'content': None, 'function_call': {'name': 'set_reminder', 'arguments': arguments}}
+        return {'role': 'assistant', 'content': ' '.join(['token'] * self.tokens)}
+
+    async def chat_completions(self, request):
+        from aiohttp import web
+        self.requests += 1
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+        message = self.completion(body)
+        base = {'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model')}
+
+        if not body.get('stream'):
+            await asyncio.sleep(self.token_interval * self.tokens)
+            return web.json_response(dict(base, choices=[{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+                                          usage={'prompt_tokens': 0, 'completion_tokens': self.tokens, 'total_tokens': self.tokens}))
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for index in range(self.tokens):
+            delta = {'content': ('token' if index == 0 else ' token')}
+            chunk = dict(base, object='chat.completion.chunk', choices=[{'index': 0, 'delta': delta, 'finish_reason': None}])
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            await asyncio.sleep(self.token_interval)
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+#############################################
+# YouTube stand-ins
+#############################################
+
+class FakeSearchRequest:
+    def __init__(self, latency, query, max_results):
+        self.latency = latency
+        self.query = query
+        self.max_results = max_results
+
+    def execute(self):
+        time.sleep(self.latency)
+        video_id = f'{abs(hash(self.query)) % 10 ** 11:011d}'
+        return {'items': [{'id': {'kind': 'youtube#video', 'videoId': video_id}, 'snippet': {'title': self.query}}]}
+
+class FakeYoutube:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def search(self):
+        return self
+
+    def list(self, q, part, maxResults):
+        return FakeSearchRequest(self.latency, q, maxResults)
+
+class FakeYoutubeDL:
+    def __init__(self, latency, directory):
+        self.latency = latency
+        self.directory = directory
+
+    def extract_info(self, url, download=False):
+        time.sleep(self.latency)
+        video_id = url.rsplit('/', 1)[-1]
+        data = {'id': video_id, 'title': video_id, 'url': f'https://media.invalid/{video_id}.webm', 'acodec': 'opus'}
+        if download:
+            with open(self.prepare_filename(data), 'wb') as song:
+                song.write(b'\0' * 1024)
+        return data
+
+    def prepare_filename(self, data):
+        return os.path.join(self.directory, f"{data['id']}.webm")
+
+#############################################
+# Discord stand-ins
+#############################################
+
+class FakeMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.channel.edits += 1
+        self.content = content
+
+class FakeChannel:
+    def __init__(self, channel_id, latency):
+        self.id = channel_id
+        self.name = f'channel-{channel_id}'
+        self.latency = latency
+        self.sent = 0
+        self.edits = 0
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        return FakeMessage(self, content)
+
+class FakePermissions:
+    connect = True
+    speak = True
+
+class FakeVoiceClient:
+    def __init__(self, song_seconds):
+        self.song_seconds = song_seconds
+        self.playing = False
+        self.timer = None
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.playing
+
+    def is_paused(self):
+        return False
+
+    # Like discord.py, `after` is called from another thread when the song ends, and playing while
+    # already playing raises instead of restarting.
+    def play(self, source, after=None):
+        import discord
+        if not self.connected:
+            raise discord.ClientException('Not connected to voice.')
+        if self.playing:
+            raise discord.ClientException('Already playing audio.')
+        self.playing = True
+        def finished():
+            self.playing = False
+            if after is not None:
+                after(None)
+        self.timer = threading.Timer(self.song_seconds, finished)
+        self.timer.start()
+
+    def stop(self):
+        self.playing = False
+
+    # Stop without calling `after`, at the end of the benchmark.
+    def disconnect(self):
+        self.connected = False
+        if self.timer is not None:
+            self.timer.cancel()
+        self.playing = False
+
+class FakeVoiceChannel:
+    def __init__(self, guild, song_seconds):
+        self.guild = guild
+        self.song_seconds = song_seconds
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self.song_seconds)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id, song_seconds):
+        self.id = guild_id
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self, song_seconds)
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+class FakeAuthor:
+    def __init__(self, name, voice):
+        self.name = name
+        self.voice = voice
+
+class FakeContext:
+    def __init__(self, channel, guild, author):
+        self.channel = channel
+        self.guild = guild
+        self.author = author
+        self.me = object()
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+class FakeBot:
+    def __init__(self, channels):
+        self.channels = {channel.id: channel for channel in channels}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+class World:
+    def __init__(self, args):
+        self.channels = [FakeChannel(1000 + i, args.discord_latency) for i in range(args.channels)]
+        self.guilds = [FakeGuild(i, args.song_seconds) for i in range(args.guilds)]
+        self.bot = FakeBot(self.channels)
+
+    def context(self, index):
+        guild = self.guilds[index % len(self.guilds)]
+        author = FakeAuthor(f'user{index % 50}', FakeVoiceState(guild.voice_channel))
+        return FakeContext(self.channels[index % len(self.channels)], guild, author)
+
+    def messages_sent(self):
+        return sum(channel.sent for channel in self.channels), sum(channel.edits for channel in self.channels)
+
+#############################################
+# Scenarios
+#############################################
+
+async def run_concurrently(count, concurrency, call):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+    async def one(index):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await call(index)
+            except Exception as e:
+                errors.append(e)
+                return
+            latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(count)))
+    return latencies, errors, time.perf_counter() - start
+
+async def run_route(label, args, world):
+    from app.fefe import talk_to_fefe
+    from app.training_data import sample_data
+    messages = [' '.join(message.split()) for message, message_label in sample_data.items() if message_label == label]
+    async def call(index):
+        message = messages[index % len(messages)]
+        if not args.repeat_messages:
+            message = f'{message} ({index})'
+        await talk_to_fefe(world.context(index), message, world.bot)
+    return await run_concurrently(args.requests, args.concurrency, call)
+
+async def run_send_reminders(args, world):
+    from app.bot_functions import send_reminders
+    from datetime import datetime
+    due = [(datetime.now(), index, f'user{index % 50}', f'Benchmark reminder {index}', str(world.channels[index % len(world.channels)].id))
+           for index in range(args.reminders)]
+    # One call with every reminder, like a busy minute.
+    latencies, errors, wall = await run_concurrently(1, 1, lambda index: send_reminders(world.bot, due))
+    return latencies, errors, wall, args.reminders
+
+async def run_train(args):
+    from app.config import keras_model_dir
+    from app.classifier import train_keras
+    async def call(index):
+        # Remove the saved model so every run trains from scratch.
+        shutil.rmtree(keras_model_dir, ignore_errors=True)
+        await train_keras()
+    return await run_concurrently(args.train_runs, 1, call)
+
+def report(name, latencies, errors, wall, count, sent):
+    rate = count / wall if wall else float('inf')
+    print(f"{name:<15} {count:>6} {len(errors):>6} {percentile(latencies, 0.50) * 1000:>9.1f} "
+          f"{percentile(latencies, 0.95) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f} {rate:>10.1f} {sent:>7}")
+    if errors:
+        print(f"{'':<15} first error: {type(errors[0]).__name__}: {errors[0]}")
+
+async def run(args, directory):
+    import openai
+    from app.database import get_db, close_db
+    from app.bot_functions import create_prompts_table, create_labeled_prompts_table, create_reminder_table
+    from app.youtube_cache import create_youtube_cache_table
+    from app.audio_cache import create_audio_cache_table
+    from app.conversation_summary import create_channel_summaries_table, conversation_summaries
+    from app.classifier import train_keras
+    from app.metrics import metrics
+    from app.llm_client import close_http_session
+    import app.music_player as music_player
+
+    llm = FakeOpenAI(args.llm_latency, args.llm_tokens, args.llm_token_interval)
+    await llm.start()
+    openai.api_base = llm.url
+    openai.api_key = 'benchmark'
+
+    fake_ytdl = FakeYoutubeDL(args.ytdl_latency, directory)
+    music_player.get_ytdl = lambda: fake_ytdl
+    async def create_audio_source(song, options, codec):
+        return song
+    music_player.create_audio_source = create_audio_source
+
+    await get_db()
+    for create_table in [create_prompts_table, create_labeled_prompts_table, create_reminder_table,
+                         create_youtube_cache_table, create_audio_cache_table, create_channel_summaries_table]:
+        await create_table()
+    await train_keras()
+
+    world = World(args)
+    print(f"{args.requests} requests per route, concurrency {args.concurrency}, openAI {args.llm_latency * 1000:.0f} ms + "
+          f"{args.llm_tokens} tokens x {args.llm_token_interval * 1000:.0f} ms, {'streaming' if args.stream else 'not streaming'}\n")
+    print(f"{'scenario':<15} {'count':>6} {'errors':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'per sec':>10} {'sends':>7}")
+    for scenario in args.scenarios:
+        sent_before, edits_before = world.messages_sent()
+        if scenario in ('other', 'reminder', 'youtube'):
+            latencies, errors, wall = await run_route(scenario, args, world)
+            count = args.requests
+        elif scenario == 'send_reminders':
+            latencies, errors, wall, count = await run_send_reminders(args, world)
+        elif scenario == 'train':
+            latencies, errors, wall = await run_train(args)
+            count = args.train_runs
+        sent_after, edits_after = world.messages_sent()
+        report(scenario, latencies, errors, wall, count, sent_after - sent_before)
+    print(f"\nopenAI requests: {llm.requests}")
+    # Tracks the player couldn't start, e.g. because the voice client was already playing.
+    skipped = sum(value for (name, labels), value in metrics.counters.items() if name == 'fefe_errors_total' and dict(labels)['stage'] == 'play')
+    print(f"songs skipped: {skipped}")
+
+    # Let background work (summaries, cache downloads) finish before closing the database.
+    await asyncio.gather(*conversation_summaries.tasks, return_exceptions=True)
+    for guild in world.guilds:
+        if guild.voice_client is not None:
+            guild.voice_client.disconnect()
+    for player in music_player.players.values():
+        player.stop()
+    # Let tracks that were already starting see the disconnect.
+    await asyncio.sleep(0.1)
+    await asyncio.gather(*music_player.audio_cache.tasks, return_exceptions=True)
+    await close_http_session()
+    await close_db()
+    await llm.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', default=['other', 'reminder', 'youtube', 'send_reminders', 'train'],
+                        choices=['other', 'reminder', 'youtube', 'send_reminders', 'train'])
+    parser.add_argument('--requests', type=int, default=200, help='messages per route')
+    parser.add_argument('--concurrency', type=int, default=20, help='messages in flight at once')
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--reminders', type=int, default=500, help='due reminders for the send_reminders scenario')
+    parser.add_argument('--train-runs', type=int, default=3)
+    parser.add_argument('--backend', help="classifier backend, e.g. 'numpy' when TensorFlow isn't installed")
+    parser.add_argument('--stream', action='store_true', help='stream openAI responses into Discord')
+    parser.add_argument('--repeat-messages', action='store_true', help='reuse the same messages so the caches are warm')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='seconds before the first token')
+    parser.add_argument('--llm-tokens', type=int, default=50)
+    parser.add_argument('--llm-token-interval', type=float, default=0.005, help='seconds between tokens')
+    parser.add_argument('--youtube-latency', type=float, default=0.1, help='seconds per YouTube search')
+    parser.add_argument('--ytdl-latency', type=float, default=0.3, help='seconds per yt_dlp lookup')
+    parser.add_argument('--discord-latency', type=float, default=0.05, help='seconds per Discord send or edit')
+    parser.add_argument('--song-seconds', type=float, default=0.5, help='how long each song "plays"')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The app modules copy their settings from app.config when they are imported, so the
+        # stand-ins have to be configured before anything else from app/ is loaded.
+        import app.config as config
+        config.db_name = os.path.join(directory, 'benchmark.db')
+        config.keras_model_dir = os.path.join(directory, 'model')
+        config.audio_cache_directory = directory
+        config.openai_stream_responses = args.stream
+        config.youtube_client = FakeYoutube(args.youtube_latency)
+        if args.backend:
+            config.classifier_backend = args.backend
+        asyncio.run(run(args, directory))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# Estimates how many simultaneous guild voice streams one CPU core can sustain with
+#   pcm   FFmpeg decodes to PCM and discord.py encodes every 20 ms frame to Opus (the old path)
+#   opus  FFmpeg remuxes the Opus audio and discord.py forwards the packets (`opus_passthrough`)
+#
+# Each pipeline pulls 20 ms frames the same way discord.py's audio player does, but as fast as
+# possible instead of in real time. The CPU time used (this process plus FFmpeg) is divided by the
+# seconds of audio produced; one core can sustain roughly 1 / (CPU seconds per audio second) streams.
+# `--streams` runs that many pipelines at once to check the estimate holds under contention.
+# Packet encryption and sending cost the same in both pipelines and are left out.
+#
+# Needs ffmpeg on the PATH, and libopus for the pcm pipeline. Run from the repository root:
+#     python benchmarks/voice_streams.py [--source song.webm] [--seconds 60] [--streams 1]
+#
+# Without --source a synthetic Opus test file is generated. A real song gives more realistic numbers.
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import discord
+
+def make_test_source(directory, seconds):
+    path = os.path.join(directory, 'test.webm')
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-y',
+                    '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                    '-f', 'lavfi', '-i', f'anoisesrc=duration={seconds}:amplitude=0.1',
+                    '-filter_complex', 'amix=inputs=2', '-ac', '2', '-ar', '48000',
+                    '-c:a', 'libopus', '-b:a', '128k', path], check=True)
+    return path
+
+def run_pcm(path):
+    source = discord.FFmpegPCMAudio(path, options='-vn')
+    encoder = discord.opus.Encoder()
+    frames = 0
+    while True:
+        data = source.read()
+        if not data:
+            break
+        encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        frames += 1
+    source.cleanup()
+    return frames
+
+def run_opus(path):
+    source = discord.FFmpegOpusAudio(path, codec='copy', options='-vn')
+    frames = 0
+    while source.read():
+        frames += 1
+    source.cleanup()
+    return frames
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def measure(pipeline, path, streams):
+    frames = [0] * streams
+    def worker(index):
+        frames[index] = pipeline(path)
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(streams)]
+    cpu_start = cpu_seconds()
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - wall_start
+    cpu = cpu_seconds() - cpu_start
+    audio = sum(frames) * 0.02
+    return {'audio_s': audio, 'cpu_s': cpu, 'wall_s': wall,
+            'cpu_per_audio_s': cpu / audio if audio else float('inf')}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', help='audio file to play (Opus in WebM/Ogg for a true passthrough)')
+    parser.add_argument('--seconds', type=int, default=60, help='length of the generated test file')
+    parser.add_argument('--streams', type=int, default=1, help='pipelines to run at once')
+    parser.add_argument('--pipelines', nargs='+', default=['pcm', 'opus'])
+    args = parser.parse_args()
+
+    pipelines = {'pcm': run_pcm, 'opus': run_opus}
+    if 'pcm' in args.pipelines and not discord.opus.is_loaded():
+        discord.opus._load_default()
+        if not discord.opus.is_loaded():
+            print('libopus not found, skipping the pcm pipeline.')
+            args.pipelines = [name for name in args.pipelines if name != 'pcm']
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.source or make_test_source(directory, args.seconds)
+        print(f"source: {path}, {args.streams} concurrent stream(s)\n")
+        print(f"{'pipeline':<9} {'audio (s)':>10} {'cpu (s)':>9} {'cpu/audio':>10} {'streams/core':>13}")
+        for name in args.pipelines:
+            result = measure(pipelines[name], path, args.streams)
+            print(f"{name:<9} {result['audio_s']:>10.1f} {result['cpu_s']:>9.2f} "
+                  f"{result['cpu_per_audio_s']:>10.4f} {1 / result['cpu_per_audio_s']:>13.0f}")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,21 @@
+import time
+boot_started = time.perf_counter()
+boot_step_started = boot_started
+
+# Prints how long each step of the boot sequence took, so slow imports are easy to spot.
+# For a per-module breakdown, run `python -X importtime bot.py`.
+def boot_step(name):
+    global boot_step_started
+    now = time.perf_counter()
+    print(f"[boot] {name}: {now - boot_step_started:.2f}s")
+    boot_step_started = now
+
 import discord
 from discord.ext import commands,tasks
+boot_step('import discord')
 
 from app.config import *
+boot_step('import app.config')
 
 
 # Set up the bot with '!' as the command prefix. 
@@ -13,7 +27,17 @@ bot = commands.Bot(command_prefix="!",intents=discord.Intents.all())
 # Bot Boot Sequence
 ########################################################################
 from app.bot_functions import *
-from app.keras_layer import *
+from app.database import close_db
+from app.prompt_retention import prompt_retention
+from app.youtube_cache import create_youtube_cache_table, youtube_cache
+from app.audio_cache import create_audio_cache_table, audio_cache
+from app.conversation_summary import create_channel_summaries_table
+from app.metrics import metrics, stage_timer, record_error, start_metrics_server
+from app.message_sender import send_chunks
+from app.llm_client import close_http_session
+boot_step('import app.bot_functions')
+from app.classifier import *
+boot_step(f'import {classifier_backend} classifier')
 
 # Create the prompts table if needed when the bot starts up
 asyncio.get_event_loop().run_until_complete(create_prompts_table())
@@ -21,12 +45,23 @@ asyncio.get_event_loop().run_until_complete(create_prompts_table())
 asyncio.get_event_loop().run_until_complete(create_labeled_prompts_table())
 # Create the reminders table if needed when the bot starts up
 asyncio.get_event_loop().run_until_complete(create_reminder_table())
+# Create the youtube_cache table if needed when the bot starts up
+asyncio.get_event_loop().run_until_complete(create_youtube_cache_table())
+# Create the audio_cache table if needed when the bot starts up
+asyncio.get_event_loop().run_until_complete(create_audio_cache_table())
+# Create the channel_summaries table if needed when the bot starts up
+asyncio.get_event_loop().run_until_complete(create_channel_summaries_table())
+boot_step('create tables')
 # train the keras layer
 asyncio.get_event_loop().run_until_complete(train_keras())
+boot_step('train classifier')
+# Release the boot connections. `bot.run` starts its own event loop and the database reopens there on first use.
+asyncio.get_event_loop().run_until_complete(close_db())
 ########################################################################
 # Bot Commands
 ########################################################################
 from app.fefe import *
+boot_step('import app.fefe')
 
 @bot.command()
 async def fefe(ctx,*,message):
@@ -45,13 +80,24 @@ async def clear_reminders(ctx):
 @bot.command()
 async def retrain_keras(ctx):
     if ctx.message.author.guild_permissions.administrator:
-        await ctx.send('Training. Standby...')
-        await train_keras()
+        if classifier_retraining():
+            await ctx.send('Training is already running.')
+            return
+        # Training runs in a separate process. The bot keeps answering with the old model until it finishes.
+        status = await ctx.send('Training. Standby...')
+        async def report(progress):
+            await status.edit(content=f'Training. Standby...\n{progress}')
+        try:
+            await retrain_classifier(report)
+        except Exception as e:
+            record_error('retrain', e)
+            await ctx.send('Training failed. The previous model is still in use.')
+            return
         await ctx.send('Training complete.')
     else:
         await ctx.send('Please contact a server admin to update the keras layer')
 
-# this command stops the bot from playing music
+# this command stops the bot from playing music and clears the queue
 @bot.command()
 async def stop_music(ctx):
     voice_state = ctx.author.voice
@@ -63,32 +109,99 @@ async def stop_music(ctx):
     voice_client = discord.utils.get(bot.voice_clients, guild=ctx.guild)
 
     if voice_client and voice_client.is_connected() and voice_client.channel == voice_channel:
+        get_player(ctx.guild).stop()
         await voice_client.disconnect()
         await ctx.send("Music playback stopped.")
     else:
         await ctx.send("The bot is not currently playing any music.")
+
+# '!skip' skips the current song and plays the next one in the queue
+@bot.command()
+async def skip(ctx):
+    if get_player(ctx.guild).skip():
+        await ctx.send("Skipped.")
+    else:
+        await ctx.send("The bot is not currently playing any music.")
+
+# '!queue' lists the songs waiting to be played
+@bot.command()
+async def queue(ctx):
+    player = get_player(ctx.guild)
+    if not player.is_active() and not player.queue:
+        await ctx.send("The queue is empty.")
+        return
+    lines = []
+    if player.current is not None:
+        lines.append(f"Now playing: {player.current.title}")
+    for position, track in enumerate(player.queue, start=1):
+        # Keep the list within one Discord message
+        if position > 20:
+            lines.append(f"...and {len(player.queue) - 20} more")
+            break
+        lines.append(f"{position}. {track.title} (requested by {track.requested_by})")
+    await ctx.send("\n".join(lines))
+
+# '!clear_queue' removes every queued song. The current song keeps playing.
+@bot.command()
+async def clear_queue(ctx):
+    get_player(ctx.guild).clear()
+    await ctx.send("The queue has been cleared.")
+
+# '!stats' shows how long each stage takes and how often it fails. Must be run by an administrator.
+@bot.command()
+async def stats(ctx):
+    if ctx.message.author.guild_permissions.administrator:
+        await send_chunks(ctx, f"```\n{metrics.summary()}\n```")
+    else:
+        await ctx.send('Please contact a server admin to see the bot stats')
 ########################################################################
 # Bot tasks
 ########################################################################
 @tasks.loop(minutes=1)
 async def reminders(bot):
-    try:
-        await update_reminders_table(bot)
-        await send_reminders(bot)
+    with stage_timer('loop_maintenance'):
+        try:
+            await prompt_retention.run()
+            await youtube_cache.purge_expired()
+
+        except Exception as e:
+            record_error('loop_maintenance', e)
 
-    except Exception as e:
-        print(f"Error in send_reminders: {e}")
+# Keeps the audio cache within its disk budget and removes stray partial downloads.
+@tasks.loop(minutes=10)
+async def trim_audio_cache(bot):
+    with stage_timer('loop_trim_audio_cache'):
+        try:
+            await audio_cache.trim()
 
-@tasks.loop(minutes=90)
-async def delete_downloads(bot):
-    await delete_music_downloads(bot)
-    print('Download folder cleared')
+        except Exception as e:
+            record_error('loop_trim_audio_cache', e)
     
 # 'on_ready' function is an event handler that runs after the bot has connected to the server.
-# It starts the 'send_reminders' loop.
+# It loads pending reminders into the reminder scheduler and starts the maintenance loops.
 @bot.event
 async def on_ready():
     print(f'We have logged in as {bot.user}')
-    reminders.start(bot)
-    delete_downloads.start(bot)
+    print(f"[boot] connected {time.perf_counter() - boot_started:.2f}s after start")
+    # on_ready fires again after reconnects. Only start things once.
+    if not reminder_scheduler.running():
+        await backfill_prompt_channel_ids(bot)
+        await audio_cache.load()
+        await load_reminders()
+        reminder_scheduler.start(lambda due: send_reminders(bot, due))
+    if not reminders.is_running():
+        reminders.start(bot)
+    if not trim_audio_cache.is_running():
+        trim_audio_cache.start(bot)
+    await start_metrics_server()
+
+# Close the shared openAI HTTP session and the database when the bot shuts down. The database
+# connections run on non-daemon threads, so Python can't exit while they are open.
+close_bot = bot.close
+async def close():
+    await close_bot()
+    await close_http_session()
+    await close_db()
+bot.close = close
+
 bot.run(discord_bot_token)
\ No newline at end of file